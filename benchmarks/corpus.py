@@ -0,0 +1,202 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Fixture corpus: source distributions used by the benchmarks.
+
+Sources are defined here (so that they're versioned together with the
+code) and archived deterministically - the same bytes, and the same
+SHA256 sums, on every machine and in every run.
+
+Cases:
+  small      - pure Python, setup.py, a handful of files (tar.gz)
+  large      - thousands of modules, Sphinx docs and a big data file (tar.gz)
+  zip        - zip archive, needs to be repacked by mk-origtargz
+  cext       - C extension (tar.gz)
+  pyproject  - pyproject.toml only (PEP 621 metadata, no setup.py)
+"""
+
+import gzip
+import hashlib
+import io
+import json
+import random
+import tarfile
+import zipfile
+from os import makedirs, replace
+from os.path import exists, getsize, join
+
+# bump if sources change, archives are rebuilt if the version differs
+CORPUS_VERSION = 1
+MTIME = 1420070400  # 2015-01-01, keeps archives reproducible
+CLASSIFIERS = ['Programming Language :: Python :: 3',
+               'License :: OSI Approved :: MIT License']
+LICENSE = 'Copyright (c) 2015 Bench Author\n\nPermission is hereby granted, free of charge...\n'
+
+
+def _setup_py(name, extra=''):
+    return ("from setuptools import setup{}\n\n"
+            "setup(name='{}', version='1.0', packages=['{}']{})\n").format(
+                ', Extension' if extra else '', name, name.replace('-', '_'), extra)
+
+
+def _pkg_info(name, summary):
+    return ('Metadata-Version: 2.1\nName: {}\nVersion: 1.0\nSummary: {}\n'
+            'Home-page: https://example.org/{}\nAuthor: Bench Author\n'
+            'Author-email: bench@example.org\nLicense: MIT\n{}\n').format(
+                name, summary, name, ''.join('Classifier: {}\n'.format(i) for i in CLASSIFIERS))
+
+
+def _small():
+    return {
+        'setup.py': _setup_py('bench-small'),
+        'PKG-INFO': _pkg_info('bench-small', 'small pure Python package'),
+        'README.rst': 'bench-small\n===========\n\nSmall pure Python package.\n',
+        'LICENSE': LICENSE,
+        'bench_small/__init__.py': '"""Small package."""\n\n__version__ = \'1.0\'\n',
+        'bench_small/core.py': 'def add(a, b):\n    return a + b\n',
+    }
+
+
+def _large(modules=2000, data_size=8 * 1024 * 1024):
+    files = {
+        'setup.py': _setup_py('bench-large'),
+        'PKG-INFO': _pkg_info('bench-large', 'large package with many modules'),
+        'README.rst': 'bench-large\n===========\n\nLarge package.\n',
+        'LICENSE': LICENSE,
+        'requirements.txt': 'requests>=2\nsix\n',
+        'docs/conf.py': "project = 'bench-large'\n",
+        'docs/Makefile': 'html:\n\tsphinx-build -b html . _build/html\n',
+        'docs/index.rst': 'bench-large\n===========\n',
+        'examples/demo.py': 'import bench_large\n',
+        'bench_large/__init__.py': '',
+    }
+    for i in range(modules):
+        files['bench_large/sub{}/mod{}.py'.format(i // 100, i)] = (
+            '"""Module {0}."""\n\n\ndef func{0}(value):\n    return value * {0}\n'.format(i))
+    for i in range(modules // 100):
+        files['bench_large/sub{}/__init__.py'.format(i)] = ''
+    # (almost) incompressible data, decompression time matters
+    files['bench_large/data/blob.bin'] = random.Random(42).randbytes(data_size)
+    return files
+
+
+def _zip():
+    return {
+        'setup.py': _setup_py('bench-zip'),
+        'PKG-INFO': _pkg_info('bench-zip', 'package released as zip file'),
+        'README.md': '# bench-zip\n',
+        'LICENSE': LICENSE,
+        'bench_zip/__init__.py': '',
+    }
+
+
+def _cext():
+    ext = ", ext_modules=[Extension('bench_cext._speedups', ['src/speedups.c'])]"
+    return {
+        'setup.py': _setup_py('bench-cext', ext),
+        'PKG-INFO': _pkg_info('bench-cext', 'package with C extension'),
+        'README.rst': 'bench-cext\n==========\n',
+        'LICENSE': LICENSE,
+        'bench_cext/__init__.py': '',
+        'src/speedups.c': (
+            '#include <Python.h>\n\n'
+            'static struct PyModuleDef module = {PyModuleDef_HEAD_INIT, "_speedups", NULL, -1};\n\n'
+            'PyMODINIT_FUNC PyInit__speedups(void) { return PyModule_Create(&module); }\n'),
+    }
+
+
+def _pyproject():
+    return {
+        'pyproject.toml': (
+            '[build-system]\nrequires = ["flit_core>=3.2"]\n'
+            'build-backend = "flit_core.buildapi"\n\n'
+            '[project]\nname = "bench-pyproject"\nversion = "1.0"\n'
+            'description = "pyproject.toml only package"\nlicense = {text = "MIT"}\n'
+            'authors = [{name = "Bench Author", email = "bench@example.org"}]\n'
+            'dependencies = ["attrs>=20"]\n'
+            'classifiers = [' + ', '.join(json.dumps(i) for i in CLASSIFIERS) + ']\n'),
+        'README.rst': 'bench-pyproject\n===============\n',
+        'LICENSE': LICENSE,
+        'bench_pyproject/__init__.py': '"""pyproject.toml only package."""\n',
+    }
+
+
+# case → (project name, archive extension, sources)
+CASES = {
+    'small': ('bench-small', 'tar.gz', _small),
+    'large': ('bench-large', 'tar.gz', _large),
+    'zip': ('bench-zip', 'zip', _zip),
+    'cext': ('bench-cext', 'tar.gz', _cext),
+    'pyproject': ('bench-pyproject', 'tar.gz', _pyproject),
+}
+VERSION = '1.0'
+
+
+def _write_tar_gz(fpath, top, files):
+    with open(fpath, 'wb') as raw, \
+            gzip.GzipFile(filename='', mode='wb', fileobj=raw, mtime=MTIME) as fp, \
+            tarfile.open(fileobj=fp, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        for name in sorted(files):
+            data = files[name]
+            data = data.encode('utf-8') if isinstance(data, str) else data
+            info = tarfile.TarInfo('{}/{}'.format(top, name))
+            info.size = len(data)
+            info.mtime = MTIME
+            info.mode = 0o644
+            info.uname = info.gname = 'root'
+            tar.addfile(info, io.BytesIO(data))
+
+
+def _write_zip(fpath, top, files):
+    with zipfile.ZipFile(fpath, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name in sorted(files):
+            info = zipfile.ZipInfo('{}/{}'.format(top, name), date_time=(2015, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, files[name])
+
+
+def build(destdir):
+    """Create (if needed) sdists in destdir, return list of release details."""
+    makedirs(destdir, exist_ok=True)
+    manifest_path = join(destdir, 'manifest.json')
+    if exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as fp:
+            manifest = json.load(fp)
+        if manifest.get('version') == CORPUS_VERSION and \
+                all(exists(join(destdir, i['filename'])) for i in manifest['releases']):
+            return manifest['releases']
+
+    releases = []
+    for case, (name, ext, sources) in sorted(CASES.items()):
+        top = '{}-{}'.format(name, VERSION)
+        fname = '{}.{}'.format(top, ext)
+        fpath = join(destdir, fname)
+        tmp = fpath + '.tmp'
+        (_write_zip if ext == 'zip' else _write_tar_gz)(tmp, top, sources())
+        replace(tmp, fpath)
+        with open(fpath, 'rb') as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        releases.append({'case': case, 'name': name, 'version': VERSION, 'filename': fname,
+                         'sha256': sha256, 'size': getsize(fpath)})
+
+    with open(manifest_path, 'w', encoding='utf-8') as fp:
+        json.dump({'version': CORPUS_VERSION, 'releases': releases}, fp, indent=1)
+    return releases
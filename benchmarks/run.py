@@ -0,0 +1,259 @@
+#! /usr/bin/python3
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Offline end to end benchmarks of py2dsp and pypi2debian.
+
+Every run starts from scratch (empty result dir, cache, sdist store and
+name index) and talks only to the local PyPI stand-in (see server.py).
+Reported for each run: wall time, throughput (converted packages per
+second), time spent in each stage (from --trace) and peak total RSS of
+the process tree (sampled from /proc). Results are compared with the stored baseline.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from collections import defaultdict
+from os.path import abspath, dirname, exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+import server
+
+ROOT = dirname(dirname(abspath(__file__)))
+BASELINE = join(dirname(abspath(__file__)), 'baseline.json')
+# trace event categories reported separately, everything else is summed up by category
+STAGE_CATEGORIES = {'stage', 'network', 'hook'}
+# how often (in seconds) memory usage is sampled
+SAMPLE_INTERVAL = 0.05
+
+
+def stage_times(fpath):
+    """Return total time (in seconds) per stage recorded in given trace file."""
+    result = defaultdict(float)
+    if not exists(fpath):
+        return {}
+    with open(fpath, encoding='utf-8') as fp:
+        events = json.load(fp)['traceEvents']
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        key = event['name'] if event['cat'] in STAGE_CATEGORIES else event['cat']
+        result[key] += event['dur'] / 1000000
+    return {key: round(value, 3) for key, value in sorted(result.items())}
+
+
+def tree_rss(pid):
+    """Return total RSS (in KiB) of given process and all its descendants."""
+    children = defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as fp:
+                # command name (in parentheses) can contain spaces
+                ppid = int(fp.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children[ppid].append(int(entry))
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        pids.extend(children.get(pid, ()))
+        try:
+            with open('/proc/{}/status'.format(pid)) as fp:
+                for line in fp:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def execute(command, env, cwd):
+    """Run command, return (exit code, wall time, peak RSS of process tree in MiB).
+
+    RSS of all processes (f.e. process pool workers, dpkg-buildpackage) is
+    sampled every SAMPLE_INTERVAL seconds and summed up.
+    """
+    start = perf_counter()
+    peak = 0
+    with open(join(cwd, 'output.log'), 'ab') as log_fp:
+        proc = subprocess.Popen(command, env=env, cwd=cwd, stdout=log_fp, stderr=log_fp)
+        while True:
+            peak = max(peak, tree_rss(proc.pid))
+            try:
+                proc.wait(SAMPLE_INTERVAL)
+            except subprocess.TimeoutExpired:
+                continue
+            break
+    return proc.returncode, perf_counter() - start, round(peak / 1024, 1)
+
+
+def environment(work_dir, base_url):
+    env = dict(os.environ)
+    env.update({
+        'PYPI_JSON_URL': base_url + '/pypi',
+        'PYPI_SIMPLE_URL': base_url + '/simple/',
+        'PYTHONPATH': os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')])),
+        # cold caches: nothing is shared between runs
+        'XDG_CACHE_HOME': join(work_dir, 'cache'),
+        'PYPI2DEB_TRACE': join(work_dir, 'trace.json'),
+        'DEBFULLNAME': env.get('DEBFULLNAME', 'Benchmark'),
+        'DEBEMAIL': env.get('DEBEMAIL', 'bench@example.org'),
+    })
+    return env
+
+
+def run_py2dsp(releases, base_url, tmp_dir):
+    result = {}
+    for release in releases:
+        work_dir = mkdtemp(prefix='py2dsp-{}-'.format(release['case']), dir=tmp_dir)
+        command = [sys.executable, join(ROOT, 'py2dsp'), '--root', join(work_dir, 'result'),
+                   '--quiet', release['name']]
+        code, wall, rss = execute(command, environment(work_dir, base_url), work_dir)
+        result[release['case']] = {
+            'ok': code == 0,
+            'wall': round(wall, 3),
+            'rss_mb': rss,
+            'stages': stage_times(join(work_dir, 'trace.json')),
+        }
+        print('py2dsp {:<10} {:>8.2f}s {:>8.1f} MiB {}'.format(
+            release['case'], wall, rss, '' if code == 0 else 'FAILED (see {})'.format(work_dir)))
+    return result
+
+
+def run_pypi2debian(jobs, base_url, tmp_dir, build_src_cmd):
+    work_dir = mkdtemp(prefix='pypi2debian-j{}-'.format(jobs), dir=tmp_dir)
+    root = join(work_dir, 'result')
+    command = [sys.executable, join(ROOT, 'pypi2debian'), '--root', root, '--quiet',
+               '--index', base_url + '/simple/', '--jobs', str(jobs),
+               '--src-jobs', str(jobs), '--min-free-disk', '0', '--min-free-memory', '0',
+               '--build-src-cmd', build_src_cmd]
+    code, wall, rss = execute(command, environment(work_dir, base_url), work_dir)
+
+    statuses = {}
+    db_path = join(root, 'pypi2debian.db')
+    if exists(db_path):
+        conn = sqlite3.connect(db_path)
+        statuses = dict(conn.execute('SELECT status, COUNT(*) FROM packages GROUP BY status'))
+        conn.close()
+    converted = statuses.get('ok', 0)
+    result = {
+        'ok': code == 0,
+        'wall': round(wall, 3),
+        'rss_mb': rss,
+        'packages': converted,
+        'failed': statuses.get('failed', 0),
+        'throughput': round(converted / wall, 3) if wall else 0,
+        'stages': stage_times(join(work_dir, 'trace.json')),
+    }
+    print('pypi2debian -j{:<3} {:>8.2f}s {:>8.1f} MiB {:>6.2f} pkg/s {} failed'.format(
+        jobs, wall, rss, result['throughput'], result['failed']))
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Print differences to baseline, return number of regressions."""
+    regressions = 0
+    for tool, runs in sorted(results.items()):
+        for run, values in sorted(runs.items()):
+            old = baseline.get(tool, {}).get(run)
+            if not old:
+                continue
+            # (name, old value, new value, True if higher value is better)
+            checks = [(key, old.get(key), values.get(key), key == 'throughput')
+                      for key in ('wall', 'rss_mb', 'throughput')]
+            checks.extend((key, value, values.get('stages', {}).get(key), False)
+                          for key, value in sorted(old.get('stages', {}).items()))
+            for key, old_value, value, higher_is_better in checks:
+                if not old_value or value is None:
+                    continue
+                change = (value - old_value) / old_value
+                worse = change < -tolerance if higher_is_better else change > tolerance
+                regressions += worse
+                print('{:<12} {:<10} {:<14} {:>10} → {:<10} {:>+7.1%}{}'.format(
+                    tool, run, key, old_value, value, change,
+                    '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('-j', '--jobs', default='1,4,8',
+                        help='comma separated list of pypi2debian job counts [default: 1,4,8]')
+    parser.add_argument('--skip-py2dsp', action='store_true', help='benchmark pypi2debian only')
+    parser.add_argument('--build-src-cmd', default='dpkg-buildpackage -S -uc -us -nc -d',
+                        help='pypi2debian\'s source package build command'
+                        ' ("" - debianize only)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay (in seconds) added to every PyPI stand-in response')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='baseline results [default: benchmarks/baseline.json]')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change reported as regression [default: 0.1]')
+    parser.add_argument('--output', metavar='FILE', help='save results in FILE (JSON)')
+    parser.add_argument('--keep', action='store_true', help='do not remove work dirs')
+    args = parser.parse_args()
+
+    tmp_dir = mkdtemp(prefix='pypi2deb-bench-')
+    srv = server.start(join(tmp_dir, 'corpus'), latency=args.latency)
+    base_url = 'http://{}:{}'.format(*srv.server_address[:2])
+    releases = srv.releases
+    try:
+        results = {}
+        if not args.skip_py2dsp:
+            results['py2dsp'] = run_py2dsp(releases, base_url, tmp_dir)
+        results['pypi2debian'] = {
+            'j{}'.format(jobs): run_pypi2debian(jobs, base_url, tmp_dir, args.build_src_cmd)
+            for jobs in (int(i) for i in args.jobs.split(','))}
+    finally:
+        srv.shutdown()
+        if args.keep:
+            print('work dirs kept in {}'.format(tmp_dir))
+        else:
+            rmtree(tmp_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+
+    regressions = 0
+    if exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as fp:
+            json.dump(results, fp, indent=1, sort_keys=True)
+        print('baseline saved in {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
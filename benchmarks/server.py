@@ -0,0 +1,155 @@
+#! /usr/bin/python3
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Local PyPI stand-in serving the fixture corpus.
+
+Endpoints:
+  /pypi/<name>/json, /pypi/<name>/<version>/json  - JSON API
+  /simple/                                        - Simple API index (JSON or HTML)
+  /simple/<name>/                                 - project's files
+  /packages/<filename>                            - sdists
+
+Point pypi2deb to it with PYPI_JSON_URL=http://HOST:PORT/pypi and
+PYPI_SIMPLE_URL=http://HOST:PORT/simple/ env. variables.
+"""
+
+import argparse
+import json
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import basename, dirname, join
+from time import sleep
+
+import corpus
+
+SIMPLE_JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+
+def project_details(release, base_url):
+    """Return JSON API response for given corpus release."""
+    urls = [{
+        'filename': release['filename'],
+        'url': '{}/packages/{}'.format(base_url, release['filename']),
+        'packagetype': 'sdist',
+        'python_version': 'source',
+        'size': release['size'],
+        'digests': {'sha256': release['sha256']},
+    }]
+    return {
+        'info': {
+            'name': release['name'],
+            'version': release['version'],
+            'summary': 'benchmark fixture: {} case'.format(release['case']),
+            'description': 'Benchmark fixture ({} case).'.format(release['case']),
+            'license': 'MIT',
+            'author': 'Bench Author',
+            'author_email': 'bench@example.org',
+            'home_page': 'https://example.org/{}'.format(release['name']),
+            'classifiers': corpus.CLASSIFIERS,
+            'requires_dist': None,
+        },
+        'urls': urls,
+        'releases': {release['version']: urls},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, releases, files_dir, latency=0, **kwargs):
+        self.releases = releases
+        self.files_dir = files_dir
+        self.latency = latency
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, content_type='application/json', status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            sleep(self.latency)
+        base_url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        parts = [i for i in self.path.split('?', 1)[0].split('/') if i]
+        if len(parts) in (3, 4) and parts[0] == 'pypi' and parts[-1] == 'json':
+            release = self.releases.get(parts[1].lower())
+            if release and (len(parts) == 3 or parts[2] == release['version']):
+                body = json.dumps(project_details(release, base_url)).encode('utf-8')
+                return self.send(body)
+        elif parts == ['simple']:
+            names = sorted(self.releases)
+            if SIMPLE_JSON_TYPE in self.headers.get('Accept', ''):
+                body = json.dumps({'meta': {'api-version': '1.0'},
+                                   'projects': [{'name': i} for i in names]})
+                return self.send(body.encode('utf-8'), SIMPLE_JSON_TYPE)
+            body = '<html><body>\n{}</body></html>\n'.format(
+                ''.join('<a href="/simple/{0}/">{0}</a>\n'.format(i) for i in names))
+            return self.send(body.encode('utf-8'), 'text/html')
+        elif len(parts) == 2 and parts[0] == 'simple' and parts[1].lower() in self.releases:
+            release = self.releases[parts[1].lower()]
+            body = '<html><body><a href="/packages/{0}#sha256={1}">{0}</a></body></html>\n'.format(
+                release['filename'], release['sha256'])
+            return self.send(body.encode('utf-8'), 'text/html')
+        elif len(parts) == 2 and parts[0] == 'packages':
+            fname = basename(parts[1])
+            if any(i['filename'] == fname for i in self.releases.values()):
+                with open(join(self.files_dir, fname), 'rb') as fp:
+                    return self.send(fp.read(), 'application/octet-stream')
+        self.send(b'not found\n', 'text/plain', 404)
+
+
+def start(files_dir, host='127.0.0.1', port=0, latency=0):
+    """Build the corpus and serve it in a background thread, return the server.
+
+    :param latency: delay (in seconds) added to every response
+    """
+    releases = {i['name']: i for i in corpus.build(files_dir)}
+    handler = partial(Handler, releases=releases, files_dir=files_dir, latency=latency)
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.releases = sorted(releases.values(), key=lambda i: i['case'])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='delay (in seconds) added to every response')
+    parser.add_argument('--files-dir', default=join(dirname(__file__), 'corpus'),
+                        help='where sdists are generated [default: benchmarks/corpus]')
+    args = parser.parse_args()
+    server = start(args.files_dir, args.host, args.port, args.latency)
+    print('PYPI_JSON_URL=http://{0}:{1}/pypi PYPI_SIMPLE_URL=http://{0}:{1}/simple/'.format(
+        args.host, server.server_address[1]))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
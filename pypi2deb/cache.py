@@ -18,64 +18,522 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+"""Two-tier cache.
+
+Values are kept deserialized in a bounded, in-process LRU cache (first
+tier) in front of a store shared between processes (second tier): Redis
+or, if it's not available, an SQLite database in ~/.cache/pypi2deb/.
+Values returned from the cache are shared, do not modify them.
+"""
+
+import asyncio
 import logging
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from os import environ, makedirs
+from os.path import dirname, expanduser, join
+from time import monotonic, time
+from uuid import uuid4
 
-__all__ = ['load', 'dump']
+__all__ = ['load', 'dump', 'load_many', 'dump_many', 'aload', 'adump', 'aload_many',
+           'adump_many', 'aclose', 'stats', 'LRUCache']
 
+NAMESPACE = 'P2D:'
 try:
     import msgpack as _serializer
-    NAMESPACE = 'P2D:'
+    SERIALIZER = b'm'
 except ImportError:
-    NAMESPACE = 'P2D-j:'
+    SERIALIZER = b'j'
     try:
         import simplejson as _serializer
     except ImportError:
         import json as _serializer
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 try:
     import redis
 except ImportError:
-    conn = None
-else:
-    conn = redis.Redis()
+    redis = None
+try:
+    from redis import asyncio as aioredis
+except ImportError:
     try:
-        conn.ping()
-    except redis.ConnectionError:
-        conn = None
-if not conn:
+        import aioredis
+    except ImportError:
+        aioredis = None
+
+# first tier limits
+LOCAL_ENTRIES = int(environ.get('PYPI2DEB_CACHE_ENTRIES', 4096))
+LOCAL_BYTES = int(environ.get('PYPI2DEB_CACHE_BYTES', 64)) * 1024 * 1024
+# values shared with other processes can change, do not keep them for too long
+LOCAL_TTL = int(environ.get('PYPI2DEB_CACHE_LOCAL_TTL', 300))
+# file based second tier (used if Redis is not available)
+FILE_PATH = environ.get('PYPI2DEB_CACHE_PATH',
+                        join(environ.get('XDG_CACHE_HOME', expanduser('~/.cache')),
+                             'pypi2deb', 'cache.sqlite'))
+FILE_SIZE = int(environ.get('PYPI2DEB_CACHE_SIZE', 256)) * 1024 * 1024
+FILE_SWEEP_INTERVAL = 300
+
+
+class LRUCache:
+    """Bounded in-process cache with per entry TTL.
+
+    Size is limited by number of entries and by total size of entries
+    (as reported by the caller), least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_entries=LOCAL_ENTRIES, max_bytes=LOCAL_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data = OrderedDict()  # key → (expiration time, size, value)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            expires, size, value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl, size=0):
+        if key in self.data:
+            self._remove(key)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        self.data[key] = (monotonic() + ttl, size, value)
+        self.size += size
+        while len(self.data) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.data)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        expires, size, value = self.data.pop(key)
+        self.size -= size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.data), 'bytes': self.size}
+
+
+class _LocalBackend:
+    """Second tier used if neither Redis nor cache file is available.
+
+    Base class of backends used without asyncio, in the current process.
+    """
+
+    def get(self, key):
+        return None
+
+    def mget(self, keys):
+        return [None] * len(keys)
+
+    def setex(self, key, ttl, data):
+        pass
+
+
+class FileBackend(_LocalBackend):
+    """SQLite based second tier, safe to use from several processes.
 
-    class _FallbackCache(dict):
-        def setex(self, key, data, ttl=None):
-            self[key] = data
+    Expired entries are removed periodically, least recently used ones
+    are removed if the file grows above given size limit. The asyncio API
+    calls it in threads (waiting for other processes' locks would block
+    the event loop), the connection is shared by them.
+    """
 
-        def get(self, key, default=None):
-            return super(_FallbackCache, self).get(key, default)
+    def __init__(self, fpath=FILE_PATH, max_size=FILE_SIZE):
+        self.fpath = fpath
+        self.max_size = max_size
+        self.pid = None
+        self.last_sweep = 0
+        self.lock = threading.RLock()
 
-    conn = _FallbackCache()
+    @property
+    def conn(self):
+        if self.pid != os.getpid():  # do not share connection with forked processes
+            makedirs(dirname(self.fpath), exist_ok=True)
+            self._conn = sqlite3.connect(self.fpath, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                               'value BLOB, expires REAL, atime REAL, size INTEGER)')
+            self.pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        return self.mget([key])[0]
+
+    def mget(self, keys):
+        with self.lock:
+            return self._mget(keys)
+
+    def _mget(self, keys):
+        now = time()
+        conn = self.conn
+        found = {}
+        for key in keys:
+            row = conn.execute('SELECT value FROM cache WHERE key = ? AND expires > ?',
+                               (key, now)).fetchone()
+            if row is not None:
+                found[key] = row[0]
+        if found:
+            conn.executemany('UPDATE cache SET atime = ? WHERE key = ?',
+                             ((now, key) for key in found))
+        return [found.get(key) for key in keys]
+
+    def setex(self, key, ttl, data):
+        with self.lock:
+            self._setex(key, ttl, data)
+
+    def _setex(self, key, ttl, data):
+        now = time()
+        self.conn.execute('INSERT OR REPLACE INTO cache (key, value, expires, atime, size) '
+                          'VALUES (?, ?, ?, ?, ?)', (key, data, now + ttl, now, len(data)))
+        if now - self.last_sweep > FILE_SWEEP_INTERVAL:
+            self.sweep()
+
+    def sweep(self):
+        """Remove expired entries, shrink the cache to fit in the size limit."""
+        with self.lock:
+            self._sweep()
+
+    def _sweep(self):
+        now = self.last_sweep = time()
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM cache WHERE expires <= ?', (now,))
+            total = conn.execute('SELECT coalesce(sum(size), 0) FROM cache').fetchone()[0]
+            if total > self.max_size:
+                to_remove = []
+                for key, size in conn.execute('SELECT key, size FROM cache ORDER BY atime'):
+                    if total <= self.max_size:
+                        break
+                    to_remove.append((key,))
+                    total -= size
+                conn.executemany('DELETE FROM cache WHERE key = ?', to_remove)
+                log.debug('%d entries removed from %s', len(to_remove), self.fpath)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
 
 
 log = logging.getLogger('pypi2deb')
+_local = LRUCache()
+_no_backend = _LocalBackend()
+_conn = None
+_aconn = None
+_aconn_lock = None
 
 
-def load(key, default=None):
-    result = conn.get(NAMESPACE + key)
-    if result is None:
+def _file_backend():
+    """Return file based backend (or a no-op one if cache file is not usable)."""
+    if not FILE_SIZE:
+        return _no_backend
+    backend = FileBackend()
+    try:
+        backend.sweep()
+    except Exception as err:
+        log.debug('cannot use cache file %s: %s', FILE_PATH, err)
+        return _no_backend
+    return backend
+
+
+def _connection():
+    """Return Redis connection (or a local backend if Redis is not available)."""
+    global _conn
+    if _conn is None:
+        if redis is not None:
+            conn = redis.Redis()
+            try:
+                conn.ping()
+            except redis.ConnectionError:
+                log.debug('cannot connect to Redis, using local cache file')
+            else:
+                _conn = conn
+        if _conn is None:
+            _conn = _aconn if isinstance(_aconn, _LocalBackend) else _file_backend()
+    return _conn
+
+
+async def _aconnection():
+    """Return asyncio Redis connection (or a no-op backend as a fallback)."""
+    global _aconn, _aconn_lock
+    if _aconn is not None:
+        return _aconn
+    if _aconn_lock is None:
+        _aconn_lock = asyncio.Lock()
+    async with _aconn_lock:
+        if _aconn is None:
+            conn = aioredis.Redis() if aioredis is not None else None
+            try:
+                if conn is not None:
+                    await conn.ping()
+            except Exception:
+                log.debug('cannot connect to Redis, using local cache file')
+                conn = None
+            if conn is None:
+                if isinstance(_conn, _LocalBackend):
+                    conn = _conn
+                else:
+                    conn = await asyncio.to_thread(_file_backend)
+            _aconn = conn
+    return _aconn
+
+
+async def aclose():
+    """Close asyncio Redis connection (it's bound to the running event loop)."""
+    global _aconn, _aconn_lock
+    if _aconn is not None and not isinstance(_aconn, _LocalBackend):
+        # close() is deprecated since redis 5.0.1
+        close = getattr(_aconn, 'aclose', None) or _aconn.close
+        await close()
+        _aconn = None
+    _aconn_lock = None
+
+
+def stats():
+    """Return first tier's hit / miss / eviction counters."""
+    return _local.stats()
+
+
+def _local_ttl(conn, ttl):
+    return ttl if conn is _no_backend else min(ttl, LOCAL_TTL)
+
+
+# Values are stored in an envelope: MAGIC, format version, serializer
+# (m: msgpack, j: JSON) and codec (-: none, z: zlib, s: zstd, c: list of chunks)
+# followed by the payload. Values stored in a different format are ignored.
+MAGIC = b'P2D'
+FORMAT_VERSION = b'\x01'
+COMPRESS_MIN_SIZE = 1024
+CHUNK_SIZE = 512 * 1024
+
+
+def _compress(data):
+    if zstandard is not None:
+        return b's', zstandard.ZstdCompressor(level=3).compress(data)
+    return b'z', zlib.compress(data, 1)
+
+
+def _decompress(codec, data):
+    if codec == b'-':
+        return data
+    if codec == b'z':
+        return zlib.decompress(data)
+    if codec == b's' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError('unsupported codec: {}'.format(codec))
+
+
+def _header(serializer, codec):
+    return MAGIC + FORMAT_VERSION + serializer + codec
+
+
+def _chunk_keys(key, value):
+    """Return keys of chunks if value is a manifest of a chunked value."""
+    if value is None or value[:len(MAGIC) + 1] != MAGIC + FORMAT_VERSION \
+       or value[len(MAGIC) + 2:len(MAGIC) + 3] != b'c':
+        return
+    count, token = value[len(MAGIC) + 3:].decode('ascii').split(':')
+    return ['{}{}#{}#{}'.format(NAMESPACE, key, token, i) for i in range(int(count))]
+
+
+def _loads(key, value, default):
+    if value is None:
+        return default
+    if value[:len(MAGIC) + 1] != MAGIC + FORMAT_VERSION:
+        log.debug('ignoring cache (%s) stored in a different format', key)
+        return default
+    serializer = value[len(MAGIC) + 1:len(MAGIC) + 2]
+    codec = value[len(MAGIC) + 2:len(MAGIC) + 3]
+    if serializer != SERIALIZER:
+        log.debug('ignoring cache (%s) stored with a different serializer', key)
         return default
     try:
-        return _serializer.loads(result, encoding='utf-8')
+        data = _decompress(codec, value[len(MAGIC) + 3:])
+        if SERIALIZER == b'm':
+            return _serializer.loads(data, raw=False)
+        return _serializer.loads(data)
     except Exception as err:
         exc_info = log.level <= logging.DEBUG
         log.warn('cannot load cache (%s): %s', key, err, exc_info=exc_info)
         return default
 
 
-def dump(key, data, ttl=3600):
-    exc_info = log.level <= logging.DEBUG
+def _dumps(key, data):
+    """Serialize data, return {storage key: value} dict (value can be chunked)."""
     try:
         data = _serializer.dumps(data)
     except Exception as err:
+        exc_info = log.level <= logging.DEBUG
         log.warn('cannot serialize cache (%s): %s', key, err, exc_info=exc_info)
         return
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    codec = b'-'
+    if len(data) >= COMPRESS_MIN_SIZE:
+        codec, data = _compress(data)
+    value = _header(SERIALIZER, codec) + data
+    if len(value) <= CHUNK_SIZE:
+        return {NAMESPACE + key: value}
+
+    token = uuid4().hex[:8]
+    chunks = [value[i:i + CHUNK_SIZE] for i in range(0, len(value), CHUNK_SIZE)]
+    manifest = _header(SERIALIZER, b'c') + '{}:{}'.format(len(chunks), token).encode('ascii')
+    result = {NAMESPACE + key: manifest}
+    for i, chunk in enumerate(chunks):
+        result['{}{}#{}#{}'.format(NAMESPACE, key, token, i)] = chunk
+    return result
+
+
+def _join_chunks(chunks):
+    if any(chunk is None for chunk in chunks):
+        return  # some chunks expired already
+    return b''.join(chunks)
+
+
+def _remember(key, value):
+    """Deserialize value from second tier and store it in the first one."""
+    result = _loads(key, value, None)
+    if result is not None:
+        _local.set(key, result, LOCAL_TTL, len(value))
+    return result
+
+
+def load(key, default=None):
+    return load_many([key], default)[0]
+
+
+def load_many(keys, default=None):
+    """Load several keys at once, return list of values."""
+    results = {key: _local.get(key) for key in keys}
+    missing = [key for key, value in results.items() if value is None]
+    if missing:
+        conn = _connection()
+        try:
+            values = conn.mget([NAMESPACE + key for key in missing])
+            for i, (key, value) in enumerate(zip(missing, values)):
+                chunk_keys = _chunk_keys(key, value)
+                if chunk_keys:
+                    values[i] = _join_chunks(conn.mget(chunk_keys))
+        except Exception as err:
+            log.warn('cannot load cache (%s): %s', ', '.join(missing), err)
+            values = [None] * len(missing)
+        for key, value in zip(missing, values):
+            results[key] = _remember(key, value)
+    return [default if results[key] is None else results[key] for key in keys]
+
+
+def dump(key, data, ttl=3600):
+    dump_many({key: data}, ttl)
+
+
+def dump_many(items, ttl=3600):
+    """Dump several {key: value} items using one pipelined call."""
+    conn = _connection()
+    chunks = {}
+    manifests = {}
+    for key, data in items.items():
+        serialized = _dumps(key, data)
+        if serialized is not None:
+            _local.set(key, data, _local_ttl(conn, ttl),
+                       sum(len(i) for i in serialized.values()))
+            manifests[NAMESPACE + key] = serialized.pop(NAMESPACE + key)
+            chunks.update(serialized)
+    if not manifests:
+        return
     try:
-        conn.setex(NAMESPACE + key, data, ttl)
+        # chunks first, manifests last
+        if isinstance(conn, _LocalBackend):  # local backend
+            for skey, value in list(chunks.items()) + list(manifests.items()):
+                conn.setex(skey, ttl, value)
+            return
+        pipe = conn.pipeline(transaction=False)
+        for skey, value in list(chunks.items()) + list(manifests.items()):
+            pipe.setex(skey, ttl, value)
+        pipe.execute()
     except Exception as err:
-        log.warn('cannot dump cache (%s): %s', key, err, exc_info=exc_info)
+        exc_info = log.level <= logging.DEBUG
+        log.warn('cannot dump cache (%s): %s', ', '.join(items), err, exc_info=exc_info)
+
+
+async def aload(key, default=None):
+    return (await aload_many([key], default))[0]
+
+
+async def _amget(conn, keys):
+    if isinstance(conn, _LocalBackend):  # local backend, can block
+        return await asyncio.to_thread(conn.mget, keys)
+    return await conn.mget(keys)
+
+
+async def aload_many(keys, default=None):
+    """Load several keys (with a single MGET call), return list of values."""
+    results = {key: _local.get(key) for key in keys}
+    missing = [key for key, value in results.items() if value is None]
+    if missing:
+        conn = await _aconnection()
+        try:
+            values = await _amget(conn, [NAMESPACE + key for key in missing])
+            for i, (key, value) in enumerate(zip(missing, values)):
+                chunk_keys = _chunk_keys(key, value)
+                if chunk_keys:
+                    values[i] = _join_chunks(await _amget(conn, chunk_keys))
+        except Exception as err:
+            log.warn('cannot load cache (%s): %s', ', '.join(missing), err)
+            values = [None] * len(missing)
+        for key, value in zip(missing, values):
+            results[key] = _remember(key, value)
+    return [default if results[key] is None else results[key] for key in keys]
+
+
+def _setex_many(conn, items, ttl):
+    for key, value in items:
+        conn.setex(key, ttl, value)
+
+
+async def adump(key, data, ttl=3600):
+    await adump_many({key: data}, ttl)
+
+
+async def adump_many(items, ttl=3600):
+    """Dump several {key: value} items using one pipelined call."""
+    conn = await _aconnection()
+    chunks = {}
+    manifests = {}
+    for key, data in items.items():
+        serialized = _dumps(key, data)
+        if serialized is not None:
+            _local.set(key, data, _local_ttl(conn, ttl),
+                       sum(len(i) for i in serialized.values()))
+            manifests[NAMESPACE + key] = serialized.pop(NAMESPACE + key)
+            chunks.update(serialized)
+    if not manifests:
+        return
+    try:
+        # chunks first, manifests last
+        if isinstance(conn, _LocalBackend):  # local backend, can block
+            await asyncio.to_thread(_setex_many, conn, list(chunks.items()) +
+                                    list(manifests.items()), ttl)
+            return
+        async with conn.pipeline(transaction=False) as pipe:
+            for skey, value in list(chunks.items()) + list(manifests.items()):
+                pipe.setex(skey, ttl, value)
+            await pipe.execute()
+    except Exception as err:
+        exc_info = log.level <= logging.DEBUG
+        log.warn('cannot dump cache (%s): %s', ', '.join(items), err, exc_info=exc_info)
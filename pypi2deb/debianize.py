@@ -18,20 +18,21 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
 import logging
-import pathlib
-import tomllib
 
-from configparser import ConfigParser
 from datetime import datetime
-from os import access, chmod, environ, listdir, makedirs, walk, X_OK
-from os.path import abspath, exists, isdir, join, dirname
+from os import access, chmod, environ, makedirs, walk, X_OK
+from os.path import abspath, exists, expanduser, isdir, join, dirname
 from shutil import copy
 
-from pypi2deb import VERSION, OVERRIDES_PATH, PROFILES_PATH, TEMPLATES_PATH
+from pypi2deb import VERSION, OVERRIDES_PATH, PROFILES_PATH, TEMPLATES_PATH, trace
+from pypi2deb.cache import aclose as close_cache
+from pypi2deb.depends import read_requirements, resolve
+from pypi2deb.srctree import SourceTree
 from pypi2deb.tools import execute
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader
 from debian.changelog import Changelog, Version, get_maintainer
 try:
     from simplejson import load, dump
@@ -39,7 +40,6 @@ except ImportError:
     from json import load, dump
 
 from dhpython import PKG_PREFIX_MAP
-from dhpython.pydist import guess_dependency, parse_pydep
 
 
 log = logging.getLogger('pypi2deb')
@@ -55,6 +55,50 @@ INTERPRETER_MAP = {value: key for key, value in PKG_PREFIX_MAP.items()}
 VERSIONED_I_MAP = {'python': 'python2'}
 DESC_STOP_KEYWORDS = {'changelog', 'changes', 'license', 'requirements',
                       'installation'}
+# compiled templates are kept here, set to an empty string to disable
+TEMPLATES_CACHE = environ.get('PYPI2DEB_TEMPLATES_CACHE',
+                              join(environ.get('XDG_CACHE_HOME', expanduser('~/.cache')),
+                                   'pypi2deb', 'jinja'))
+_environments = {}  # template search path → Environment
+
+
+def _environment(templates_dir):
+    """Return Jinja environment shared by packages with the same search path.
+
+    Compiled templates are reused (and reloaded if modified) as long as
+    the environment lives, bytecode is also kept on disk between runs.
+    """
+    templates_dir = tuple(templates_dir)
+    env = _environments.get(templates_dir)
+    if env is None:
+        bytecode_cache = None
+        if TEMPLATES_CACHE:
+            try:
+                makedirs(TEMPLATES_CACHE, exist_ok=True)
+                bytecode_cache = FileSystemBytecodeCache(TEMPLATES_CACHE)
+            except OSError as err:
+                log.debug('cannot use templates cache: %s', err)
+        env = _environments[templates_dir] = Environment(
+            loader=FileSystemLoader(templates_dir), bytecode_cache=bytecode_cache,
+            auto_reload=True)
+    return env
+
+
+class _Templates:
+    """Shared environment that prefers templates found in sources.
+
+    If sources provide any of the templates, they take precedence over
+    all others (also in {% include %} and {% extends %}), so such package
+    gets its own overlay of the shared environment.
+    """
+
+    def __init__(self, dpath, env):
+        self.env = env
+        if any(exists(join(dpath, name)) for name in env.list_templates()):
+            self.env = env.overlay(loader=ChoiceLoader([FileSystemLoader(dpath), env.loader]))
+
+    def get_template(self, name):
+        return self.env.get_template(name)
 
 
 def _copy_static_files(src_dir, debian_dir):
@@ -71,14 +115,12 @@ def _copy_static_files(src_dir, debian_dir):
 
 
 async def debianize(dpath, ctx, profile=None):
-    update_ctx(dpath, ctx)
+    tree = SourceTree(dpath)
+    update_ctx(dpath, ctx, tree)
 
-    setupcfg_fpath = join(dpath, 'setup.cfg')
-    if exists(setupcfg_fpath):
-        upstream_cfg = ConfigParser()
-        upstream_cfg.read(setupcfg_fpath)
-        if 'py2dsp' in upstream_cfg:
-            ctx.update(upstream_cfg['py2dsp'].items())
+    upstream_cfg = tree.setup_cfg
+    if upstream_cfg is not None and 'py2dsp' in upstream_cfg:
+        ctx.update(upstream_cfg['py2dsp'].items())
 
     override_paths = [TEMPLATES_PATH]
 
@@ -122,12 +164,16 @@ async def debianize(dpath, ctx, profile=None):
         fpath = abspath(join(o_dpath, 'hooks', 'pre'))
         if exists(fpath) and access(fpath, X_OK):
             _dump_ctx(ctx)
-            code = await execute([fpath, ctx['src_name'],
-                                       ctx['version'], ctx['debian_revision']],
-                                      cwd=dpath)
+            with trace.span('pre hook', cat='hook', path=fpath):
+                code = await execute([fpath, ctx['src_name'],
+                                      ctx['version'], ctx['debian_revision']],
+                                     cwd=dpath)
             if code != 0:
                 raise Exception("pre hook for %s failed with %d return code" % (
                                 ctx['name'], code))
+            tree = None  # hooks can modify sources
+    if tree is None:
+        tree = SourceTree(dpath)
     for o_dpath in reversed(override_paths):
         # copy static files
         deb_dpath = join(o_dpath, 'debian')
@@ -140,41 +186,78 @@ async def debianize(dpath, ctx, profile=None):
     ctx['debian_version'] = "{}-{}".format(ctx['version'], ctx['debian_revision'])
 
     # Jinja setup: set templates directories
-    templates_dir = [dpath]  # use existing dir as a template dir as well
-    templates_dir.extend(override_paths)
+    templates_dir = list(override_paths)
     templates_dir.append(TEMPLATES_PATH)
-    env = Environment(loader=FileSystemLoader(templates_dir))
+    # use existing dir as a template dir as well
+    env = _Templates(dpath, _environment(templates_dir))
 
     # render debian dir files (note that order matters)
-    docs(dpath, ctx, env)
-    control(dpath, ctx, env)
-    rules(dpath, ctx, env)
+    with trace.span('docs', cat='render'):
+        docs(dpath, ctx, env, tree)
+    if not exists(join(dpath, 'debian', 'control')):
+        with trace.span('build_depends', cat='render'):
+            await build_depends(dpath, ctx, tree)
+    control(dpath, ctx, env, tree)
+    rules(dpath, ctx, env, tree)
     chmod(join(dpath, 'debian', 'rules'), 0o755)
-    initial_release = await changelog(dpath, ctx, env)
+    with trace.span('debian/changelog', cat='render'):
+        initial_release = await changelog(dpath, ctx, env)
     if initial_release:
-        itp_mail(dpath, ctx, env)
-    copyright(dpath, ctx, env)
-    watch(dpath, ctx, env)
+        with trace.span('itp.mail', cat='render'):
+            itp_mail(dpath, ctx, env)
+    copyright(dpath, ctx, env, tree)
+    watch(dpath, ctx, env, tree)
     # Currently only Github is supported for DEP-12
     if 'github' in ctx:
-        upstream__metadata(dpath, ctx, env)
-    clean(dpath, ctx, env)
+        upstream__metadata(dpath, ctx, env, tree)
+    with trace.span('debian/clean', cat='render'):
+        clean(dpath, ctx, env)
 
     # invoke post hooks
     for o_dpath in override_paths:
         fpath = join(o_dpath, 'hooks', 'post')
         if exists(fpath) and access(fpath, X_OK):
             _dump_ctx(ctx)
-            code = await execute([fpath, ctx['src_name'],
-                                       ctx['version'], ctx['debian_revision'],
-                                       VERSION],
-                                      cwd=dpath)
+            with trace.span('post hook', cat='hook', path=fpath):
+                code = await execute([fpath, ctx['src_name'],
+                                      ctx['version'], ctx['debian_revision'],
+                                      VERSION],
+                                     cwd=dpath)
             if code != 0:
                 raise Exception("post hook for %s failed with %d return code" % (
                                 ctx['name'], code))
 
 
-def update_ctx(dpath, ctx):
+async def _debianize_once(dpath, ctx, profile):
+    try:
+        await debianize(dpath, ctx, profile)
+    finally:
+        # the connection is bound to this (short-lived) event loop
+        await close_cache()
+
+
+def debianize_sync(dpath, ctx, profile=None, trace_ctx=None):
+    """Synchronous version of debianize, meant to be run in process pool.
+
+    Returns updated ctx (changes made in worker process are not visible in
+    the parent one) and trace events recorded in the worker process.
+
+    :param trace_ctx: parent's trace.context() or None if tracing is disabled
+    """
+    if trace_ctx is not None:
+        trace.enable()
+        trace.set_worker(trace_ctx['worker'])
+        trace.set_package(trace_ctx['package'])
+    try:
+        with trace.span('debianize'):
+            asyncio.run(_debianize_once(dpath, ctx, profile))
+    finally:
+        events = trace.collect()
+    return ctx, events
+
+
+def update_ctx(dpath, ctx, tree=None):
+    tree = tree or SourceTree(dpath)
     ctx.setdefault('exports', {})
     ctx.setdefault('build_depends', set())
     maintainer, email = get_maintainer()
@@ -186,18 +269,20 @@ def update_ctx(dpath, ctx):
 
     ctx['binary_arch'] = 'all'
     ctx.setdefault('clean_files', set())
-    for root, dirs, file_names in walk(dpath):
-        if any(fname.endswith(('.c', '.cpp', '.pyx')) for fname in file_names):
-            ctx['binary_arch'] = 'any'
-
-            for fname in file_names:
-                if fname.endswith('.pyx'):
-                    if 'python3' in ctx['interpreters']:
-                        ctx['build_depends'].add('cython3')
-                    for ext in ('c', 'cpp'):
-                        fname_c = fname[:-3] + ext
-                        if fname_c in file_names:
-                            ctx['clean_files'].add(join(root.replace(dpath, '.'), fname_c))
+    if not any(tree.extensions[ext] for ext in ('.c', '.cpp', '.pyx')):
+        return
+    ctx['binary_arch'] = 'any'
+    if not tree.extensions['.pyx']:
+        return
+    for root, file_names in tree.walk():
+        for fname in file_names:
+            if fname.endswith('.pyx'):
+                if 'python3' in ctx['interpreters']:
+                    ctx['build_depends'].add('cython3')
+                for ext in ('c', 'cpp'):
+                    fname_c = fname[:-3] + ext
+                    if fname_c in file_names:
+                        ctx['clean_files'].add(join(root, fname_c))
 
 
 def _dump_ctx(ctx):
@@ -212,14 +297,14 @@ def _dump_ctx(ctx):
         log.debug('cannot dump ctx', exc_info=True)
 
 
-def docs(dpath, ctx, env):
+def docs(dpath, ctx, env, tree):
     docs = ctx.setdefault('docs', {})
     for path in SPHINX_DIR:
-        if exists(join(dpath, path, 'Makefile')) and exists(join(dpath, path, 'conf.py')):
+        if tree.exists(join(path, 'Makefile')) and tree.exists(join(path, 'conf.py')):
             docs['sphinx_dir'] = path
             ctx['build_depends'].add('python3-sphinx')
             docs.setdefault('files', []).append('.pybuild/docs/*')
-    for fn in listdir(dpath):
+    for fn in sorted(tree.listdir()):
         if fn.lower().startswith('readme'):
             docs.setdefault('files', []).append(fn)
         if fn.lower() == 'examples':
@@ -250,19 +335,35 @@ def _render_template(func):
         if exists(fpath):
             log.debug('debian/%s already exist, skipping', name)
             return
-        ctx = func(dpath, ctx, env, *args, **kwargs)
-        tpl = env.get_template('debian/{}.tpl'.format(name))
+        with trace.span('debian/' + name, cat='render'):
+            ctx = func(dpath, ctx, env, *args, **kwargs)
+            tpl = env.get_template('debian/{}.tpl'.format(name))
 
-        if not isdir(dirname(fpath)):
-            makedirs(dirname(fpath))
+            if not isdir(dirname(fpath)):
+                makedirs(dirname(fpath))
 
-        with open(fpath, 'w', encoding='utf-8') as fp:
-            fp.write(tpl.render(ctx))
+            with open(fpath, 'w', encoding='utf-8') as fp:
+                fp.write(tpl.render(ctx))
     return _template
 
 
+async def build_depends(dpath, ctx, tree):
+    """Add build dependencies guessed from upstream requirements to ctx."""
+    if 'requires' in ctx:
+        requires = list(ctx['requires'])
+    else:
+        requires = []
+        for i in sorted(tree.listdir()):
+            if i.endswith('.egg-info') and tree.exists(join(i, 'requires.txt')):
+                requires.extend(read_requirements(join(dpath, i, 'requires.txt')))
+            if i == 'requirements.txt':
+                requires.extend(read_requirements(join(dpath, 'requirements.txt')))
+    impls = [INTERPRETER_MAP.get(impl, impl) for impl in ctx['interpreters']]
+    ctx['build_depends'].update(await resolve(requires, impls))
+
+
 @_render_template
-def control(dpath, ctx, env):
+def control(dpath, ctx, env, tree):
     desc = []
     code_line = False
     first_line = True
@@ -295,35 +396,8 @@ def control(dpath, ctx, env):
         if key not in ctx:
             ctx[key] = value
 
-    req = set()
-    if 'requires' in ctx:
-            for impl in ctx['interpreters']:
-                impl = INTERPRETER_MAP.get(impl, impl)
-                try:
-                    dependency = guess_dependency(impl, line)
-                    if dependency:
-                        ctx['build_depends'].add(dependency)
-                except Exception as err:
-                    log.warn('cannot parse build dependency: %s', err)
-    else:
-        for i in listdir(dpath):
-            if i.endswith('.egg-info') and exists(join(dpath, i, 'requires.txt')):
-                req.add(join(dpath, i, 'requires.txt'))
-            if i == 'requirements.txt':
-                req.add(join(dpath, 'requirements.txt'))
-
-        for fpath in req:
-            for impl in ctx['interpreters']:
-                impl = INTERPRETER_MAP.get(impl, impl)
-                try:
-                    for i in parse_pydep(impl, fpath)['depends']:
-                        ctx['build_depends'].add(i)
-                except Exception as err:
-                    log.warn('cannot parse build dependency: %s', err)
-
-    pyproject_file = pathlib.Path(dpath, 'pyproject.toml')
-    if pyproject_file.exists():
-        pyproject_toml = tomllib.loads(pyproject_file.read_text())
+    pyproject_toml = tree.pyproject
+    if pyproject_toml is not None:
         if 'build-system' in pyproject_toml:
             # https://pip.pypa.io/en/stable/reference/build-system/pyproject-toml/#fallback-behaviour
             if 'build-backend' not in pyproject_toml['build-system']:
@@ -348,15 +422,12 @@ def control(dpath, ctx, env):
             log.info("Unable to detect a build system via pyproject.toml, falling back to setup.py")
 
     # either there's only a setup.py or we couldnt detect a build backend via pyproject.toml
-    if exists(join(dpath, 'setup.py')) and 'pybuild_depends' not in ctx:
+    if tree.setup_py is not None and 'pybuild_depends' not in ctx:
         ctx['pybuild_depends'] = 'dh-python'
-        with open(join(dpath, 'setup.py')) as fp:
-            for line in fp:
-                if line.startswith('#'):
-                    continue
-                if 'setuptools' in line:
-                    for interpreter in ctx['interpreters']:
-                        ctx['build_depends'].add('{}-setuptools'.format(interpreter))
+        for line in tree.setup_py:
+            if 'setuptools' in line:
+                for interpreter in ctx['interpreters']:
+                    ctx['build_depends'].add('{}-setuptools'.format(interpreter))
 
     if 'python3' in ctx['interpreters']:
         ctx['build_depends'].add(
@@ -368,22 +439,21 @@ def control(dpath, ctx, env):
 
 
 @_render_template
-def rules(dpath, ctx, env):
+def rules(dpath, ctx, env, tree):
     ctx['with'] = ','.join(VERSIONED_I_MAP.get(i, i) for i in ctx['interpreters'])
     if ctx.get('docs', {}).get('sphinx_dir'):
         ctx['with'] += ',sphinxdoc'
 
     # if package install a script in /usr/bin/ - ship it only in python3-foo package
-    if exists(join(dpath, 'setup.py')) and len(ctx['interpreters']) > 1:
-        with open(join(dpath, 'setup.py')) as fp:
-            for line in fp:
-                if 'console_scripts' in line:
-                    for interpreter in ctx['interpreters']:
-                        if interpreter == 'python3':
-                            continue
-                        ipreter = VERSIONED_I_MAP.get(interpreter, interpreter)
-                        ctx['exports']['PYBUILD_AFTER_INSTALL_{}'.format(ipreter)] = 'rm -rf {destdir}/usr/bin/'
-                    break
+    if tree.setup_py is not None and len(ctx['interpreters']) > 1:
+        for line in tree.setup_py:
+            if 'console_scripts' in line:
+                for interpreter in ctx['interpreters']:
+                    if interpreter == 'python3':
+                        continue
+                    ipreter = VERSIONED_I_MAP.get(interpreter, interpreter)
+                    ctx['exports']['PYBUILD_AFTER_INSTALL_{}'.format(ipreter)] = 'rm -rf {destdir}/usr/bin/'
+                break
 
     return ctx
 
@@ -423,7 +493,7 @@ async def changelog(dpath, ctx, env):
 
 
 @_render_template
-def copyright(dpath, ctx, env):
+def copyright(dpath, ctx, env, tree):
     if not ctx.get('deb_copyright'):
         ctx['deb_copyright'] = "{} {}".format(datetime.now().year, ctx['creator'])
     if ctx['license_name'] in ('Apache 2', 'Apache 2.0'):
@@ -447,7 +517,7 @@ def copyright(dpath, ctx, env):
 
     if not ctx.get('license'):
         license = []
-        for fn in listdir(dpath):
+        for fn in sorted(tree.files['.']):
             if not fn.lower().startswith('license'):
                 continue
             with open(join(dpath, fn), 'r') as fp:
@@ -468,11 +538,11 @@ def copyright(dpath, ctx, env):
 
 
 @_render_template
-def watch(dpath, ctx, env):
+def watch(dpath, ctx, env, tree):
     return ctx
 
 @_render_template
-def upstream__metadata(dpath, ctx, env):
+def upstream__metadata(dpath, ctx, env, tree):
     """Render debian/upstream/metadata according to DEP-12."""
     return ctx
 
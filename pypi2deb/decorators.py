@@ -18,32 +18,88 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
 import logging
 from functools import wraps
+from hashlib import blake2b
+from inspect import iscoroutinefunction
+from json import dumps
 from pypi2deb.cache import load as _cache_load, dump as _cache_dump
+from pypi2deb.cache import aload as _cache_aload, adump as _cache_adump
 
 log = logging.getLogger('pypi2deb')
 
 
+def _json_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=repr)
+    return repr(obj)
+
+
+def args_digest(args, kwargs):
+    """Return short digest of function arguments, stable across runs."""
+    data = dumps([args, kwargs], sort_keys=True, default=_json_default)
+    return blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
 def cache(ttl=3600, key=None, prefix=None):
     """Cache decorated function's result.
 
+    Coroutine functions are supported as well: the asyncio cache backend
+    is used for them and concurrent calls with the same cache key share
+    a single invocation of the decorated coroutine.
+
     :param key: static cache key
     :param prefix: prepend it to the autogenerated key
     """
 
     def _cache(func):
-        func_name = func.__name__
+        func_name = '{}.{}'.format(func.__module__, func.__qualname__)
 
-        @wraps(func)
-        def __cache(*args, **kwargs):
+        def _cache_key(args, kwargs):
             if key:
                 cache_key = key
             else:
-                cache_key = "%s:%s:%s" % (func_name, args, kwargs)
+                cache_key = "%s:%s" % (func_name, args_digest(args, kwargs))
             if prefix:
                 cache_key = "%s:%s" % (prefix, cache_key)
+            return cache_key
+
+        if iscoroutinefunction(func):
+            pending = {}
+
+            @wraps(func)
+            async def __acache(*args, **kwargs):
+                cache_key = _cache_key(args, kwargs)
+                future = pending.get(cache_key)
+                if future is not None:
+                    # the same call is already in progress
+                    return await asyncio.shield(future)
 
+                future = pending[cache_key] = asyncio.get_running_loop().create_future()
+                try:
+                    res = await _cache_aload(cache_key)
+                    if res is None:
+                        res = await func(*args, **kwargs)
+                        if res is not None:
+                            await _cache_adump(cache_key, res, ttl)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except BaseException as err:
+                    future.set_exception(err)
+                    future.exception()  # do not warn if nobody else waits for it
+                    raise
+                else:
+                    future.set_result(res)
+                finally:
+                    del pending[cache_key]
+                return res
+            return __acache
+
+        @wraps(func)
+        def __cache(*args, **kwargs):
+            cache_key = _cache_key(args, kwargs)
             res = _cache_load(cache_key)
             if res is None:
                 res = func(*args, **kwargs)
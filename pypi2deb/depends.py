@@ -0,0 +1,120 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Requirements → Debian build dependencies.
+
+Requirements are normalized and resolved in batches; results are kept in
+memory for the whole run and in the cache (until dh-python's data files
+change), so f.e. "requests>=2" is passed to dh-python only once.
+"""
+
+import asyncio
+import logging
+import re
+
+from pypi2deb import cache, nameindex
+
+from dhpython.pydist import guess_dependency
+
+__all__ = ['normalize', 'parse_requirements', 'read_requirements', 'resolve']
+
+# resolved requirements are cached for this many seconds
+CACHE_TTL = 7 * 24 * 3600
+EXTRA_MARKER_RE = re.compile(r'''\bextra\s*==''')
+NAME_RE = re.compile(r'[A-Za-z0-9._-]+')
+log = logging.getLogger('pypi2deb')
+
+_resolved = {}  # (impl, requirement) → dependency or ''
+
+
+def normalize(requirement):
+    """Return requirement in canonical form or None if it should be ignored."""
+    requirement = requirement.split('#', 1)[0].strip()
+    if not requirement or requirement.startswith('-') or '://' in requirement:
+        return  # pip options, URLs
+    requirement, _, marker = requirement.partition(';')
+    marker = ' '.join(marker.split())
+    if EXTRA_MARKER_RE.search(marker):
+        return  # optional dependency
+    # names are case insensitive, whitespace is not significant
+    requirement = ''.join(requirement.split())
+    match = NAME_RE.match(requirement)
+    if not match:
+        return
+    result = match.group().lower().replace('_', '-') + requirement[match.end():]
+    return '{}; {}'.format(result, marker) if marker else result
+
+
+def parse_requirements(lines):
+    """Return requirements from requires.txt or requirements.txt lines."""
+    result = []
+    marker = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith('['):
+            # [extra] sections are optional, [:marker] ones are not
+            section = line.strip('[]')
+            marker = section[1:] if section.startswith(':') else False
+            continue
+        if marker is False or not line:
+            continue
+        result.append('{}; {}'.format(line, marker) if marker else line)
+    return result
+
+
+def read_requirements(fpath):
+    """Return requirements listed in requires.txt or requirements.txt file."""
+    with open(fpath, encoding='utf-8', errors='replace') as fp:
+        return parse_requirements(fp)
+
+
+def _guess(queries):
+    """Ask dh-python about given (impl, requirement) pairs."""
+    result = {}
+    for impl, req in queries:
+        try:
+            result[impl, req] = guess_dependency(impl, req) or ''
+        except Exception as err:
+            log.warn('cannot parse build dependency: %s', err)
+    return result
+
+
+async def resolve(requirements, interpreters):
+    """Return set of build dependencies for all given requirements."""
+    requirements = {i for i in (normalize(req) for req in requirements) if i}
+    queries = {(impl, req) for impl in interpreters for req in requirements}
+    missing = [i for i in queries if i not in _resolved]
+    if missing:
+        signature = nameindex.signature()
+        keys = {query: 'depends:{}:{}:{}'.format(signature, *query) for query in missing}
+        unknown = []
+        for query, value in zip(missing, await cache.aload_many([keys[i] for i in missing])):
+            if value is None:
+                unknown.append(query)
+            else:
+                _resolved[query] = value
+        if unknown:
+            # dh-python reads its data files, keep it off the event loop
+            new = await asyncio.to_thread(_guess, unknown)
+            _resolved.update(new)
+            await cache.adump_many({keys[query]: value for query, value in new.items()},
+                                   CACHE_TTL)
+
+    return {_resolved[i] for i in queries if _resolved.get(i)}
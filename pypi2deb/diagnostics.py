@@ -0,0 +1,180 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Event loop diagnostics.
+
+A heartbeat coroutine measures how late the event loop wakes it up and a
+watchdog thread captures the loop thread's stack whenever the heartbeat
+is overdue, i.e. when a synchronous call blocks the loop. Stalls are
+grouped by the code that caused them and summarized at exit.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import traceback
+import weakref
+from os import environ
+from os.path import basename
+from time import monotonic
+
+__all__ = ['Monitor', 'label']
+
+# stalls shorter than this (in seconds) are not reported
+THRESHOLD = float(environ.get('PYPI2DEB_DIAGNOSTICS_THRESHOLD', 0.1))
+OWN_FILES = ('py2dsp', 'pypi2debian')
+log = logging.getLogger('pypi2deb')
+
+_labels = weakref.WeakKeyDictionary()  # task → package being processed
+
+
+def label(text):
+    """Mark current task as working on given package."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        return
+    if task is not None:
+        _labels[task] = text
+
+
+def _site(frames):
+    """Return location of our own code closest to the blocking call."""
+    for frame, lineno in reversed(frames):
+        fname = frame.f_code.co_filename
+        if '/pypi2deb/' in fname or basename(fname) in OWN_FILES:
+            return '{}:{} ({})'.format(basename(fname), lineno, frame.f_code.co_name)
+    if frames:
+        frame, lineno = frames[-1]
+        return '{}:{} ({})'.format(basename(frame.f_code.co_filename), lineno,
+                                   frame.f_code.co_name)
+    return 'unknown'
+
+
+class Monitor:
+    def __init__(self, threshold=THRESHOLD, interval=None):
+        self.threshold = threshold
+        self.interval = interval or threshold / 4
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.offenders = {}  # site → stats
+        self._lock = threading.Lock()
+        self._pending = None  # stack captured during current stall
+        self._beat = monotonic()
+        self._stopped = threading.Event()
+        self._heartbeat = self._thread = None
+
+    def start(self):
+        """Start monitoring running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self._beat = monotonic()
+        self._heartbeat = self.loop.create_task(self._heartbeat_worker())
+        self._thread = threading.Thread(target=self._watchdog, name='pypi2deb-watchdog',
+                                        daemon=True)
+        self._thread.start()
+        log.debug('event loop diagnostics enabled (threshold: %.3fs)', self.threshold)
+
+    async def stop(self):
+        self._stopped.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _heartbeat_worker(self):
+        while True:
+            before = monotonic()
+            await asyncio.sleep(self.interval)
+            now = monotonic()
+            self._beat = now
+            lag = max(now - before - self.interval, 0.0)
+            self.lag_count += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+            with self._lock:
+                pending, self._pending = self._pending, None
+            if pending:
+                self._record(lag, *pending)
+
+    def _watchdog(self):
+        while not self._stopped.wait(self.interval):
+            if monotonic() - self._beat < self.threshold:
+                continue
+            with self._lock:
+                if self._pending is not None:
+                    continue  # this stall was already captured
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            frames = list(traceback.walk_stack(frame))[::-1]
+            task = asyncio.current_task(self.loop)
+            package = _labels.get(task) if task is not None else None
+            stack = ''.join(traceback.StackSummary.extract(frames).format())
+            with self._lock:
+                self._pending = (_site(frames), stack, package)
+
+    def _record(self, lag, site, stack, package):
+        log.warn('event loop blocked for %.3fs at %s%s', lag, site,
+                 ' while processing {}'.format(package) if package else '')
+        stats = self.offenders.get(site)
+        if stats is None:
+            stats = self.offenders[site] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                            'packages': set(), 'stack': stack}
+        stats['count'] += 1
+        stats['total'] += lag
+        if lag > stats['max']:
+            stats['max'] = lag
+            stats['stack'] = stack
+        if package and len(stats['packages']) < 10:
+            stats['packages'].add(package)
+
+    def summary(self, limit=10):
+        """Return text report with the worst offenders."""
+        lines = ['event loop lag: {} samples, mean {:.4f}s, max {:.3f}s'.format(
+            self.lag_count, self.lag_total / self.lag_count if self.lag_count else 0,
+            self.lag_max)]
+        offenders = sorted(self.offenders.items(), key=lambda i: i[1]['total'], reverse=True)
+        if not offenders:
+            lines.append('no blocking calls longer than {:.3f}s detected'.format(self.threshold))
+        for site, stats in offenders[:limit]:
+            lines.append('')
+            lines.append('{}: blocked {} times, {:.3f}s in total, {:.3f}s max'.format(
+                site, stats['count'], stats['total'], stats['max']))
+            if stats['packages']:
+                lines.append('  packages: {}'.format(', '.join(sorted(stats['packages']))))
+            lines.append('  longest stall:')
+            lines.extend('  ' + line for line in stats['stack'].rstrip().split('\n'))
+        return '\n'.join(lines)
+
+    def report(self, fpath=None):
+        """Write summary to given file or log it."""
+        summary = self.summary()
+        if fpath and fpath != '-':
+            with open(fpath, 'w', encoding='utf-8') as fp:
+                fp.write(summary + '\n')
+        else:
+            log.info('diagnostics summary:\n%s', summary)
@@ -19,32 +19,94 @@
 # THE SOFTWARE.
 
 # PyGithub doesnt support (yet) asyncio, and there's only a prototype of a github
-# client supporting it, so we're gonna do it the old way
+# client supporting it, so we're gonna do it the old way (in a thread)
 
+import asyncio
 import logging
+from os import environ
 from os.path import join, exists
+from time import time
 
-import aiohttp
 from github import Github
-from github.GithubException import UnknownObjectException
+from github.GithubException import (GithubException, RateLimitExceededException,
+                                    UnknownObjectException)
 
+from pypi2deb import store
+from pypi2deb.decorators import cache
+from pypi2deb.net import HTTP_RETRIES, backoff, fetch, throttle
+
+# anonymous clients are limited to 60 API requests per hour
+GITHUB_TOKEN = environ.get('PYPI2DEB_GITHUB_TOKEN', environ.get('GITHUB_TOKEN'))
+# do not wait longer than this (in seconds) for rate limit reset
+GITHUB_MAX_WAIT = int(environ.get('PYPI2DEB_GITHUB_MAX_WAIT', 900))
+GITHUB_API_URL = 'https://api.github.com/'
 log = logging.getLogger('pypi2deb')
 
 
-async def github_download(name, github_url, version=None, destdir='.'):
-    g = Github()
-    repo_name = github_url.replace('https://github.com/', '').rstrip('/')
+def _client():
+    if not GITHUB_TOKEN:
+        return Github()
+    try:
+        from github import Auth
+    except ImportError:  # PyGithub < 1.59
+        return Github(GITHUB_TOKEN)
+    return Github(auth=Auth.Token(GITHUB_TOKEN))
+
+
+def _latest_tag(repo_name):
+    g = _client()
     log.debug(f"Calling github get_repo with arg {repo_name}")
     repo = g.get_repo(repo_name)
 
-    if not name:
-        name = repo.name
-
     try:
         tag_name = repo.get_latest_release().tag_name
     except UnknownObjectException:
         # Some projects do not use Github Releases, check the latest tag instead
         tag_name = repo.get_tags()[0].name
+    return {'name': repo.name, 'tag_name': tag_name}
+
+
+def _reset_delay(err):
+    """Return seconds to wait for rate limit reset (from GitHub's response)."""
+    headers = getattr(err, 'headers', None) or {}
+    if headers.get('retry-after'):
+        return float(headers['retry-after'])
+    if headers.get('x-ratelimit-reset'):
+        return max(0, int(headers['x-ratelimit-reset']) - time()) + 1
+    return 60
+
+
+@cache(ttl=3600, prefix='github')
+async def latest_tag(repo_name):
+    """Return repository name and its latest release (or tag) name."""
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while True:
+        try:
+            async with throttle(GITHUB_API_URL):
+                return await loop.run_in_executor(None, _latest_tag, repo_name)
+        except RateLimitExceededException as err:
+            delay = _reset_delay(err)
+            if delay > GITHUB_MAX_WAIT:
+                raise Exception('GitHub API rate limit exceeded, reset in {:.0f}s'
+                                ' (set PYPI2DEB_GITHUB_TOKEN)'.format(delay)) from err
+            log.warn('GitHub API rate limit exceeded, waiting %.0fs', delay)
+        except GithubException as err:
+            if err.status < 500 or attempt >= HTTP_RETRIES:
+                raise
+            delay = backoff(attempt + 1)
+            log.debug('%s: GitHub API error (%s), retrying in %.1fs', repo_name, err.status, delay)
+        attempt += 1
+        await asyncio.sleep(delay)
+
+
+async def github_download(name, github_url, version=None, destdir='.'):
+    repo_name = github_url.replace('https://github.com/', '').rstrip('/')
+    details = await latest_tag(repo_name)
+
+    if not name:
+        name = details['name']
+    tag_name = details['tag_name']
 
     if not version:
         # TODO: are there other special cases? vx.y.z tag gets rewritten as x.y.z
@@ -61,11 +123,9 @@ async def github_download(name, github_url, version=None, destdir='.'):
     if exists(fpath):
         return fname
 
-    async with aiohttp.ClientSession(trust_env=True) as session:
+    if not store.place(store.resolve_alias(download_url), fpath):
         log.debug(f"fetching upstream tarball from {download_url}")
-        response = await session.get(download_url)
-        with open(fpath, 'ba') as fp:
-            data = await response.read()
-            fp.write(data)
+        sha256 = await fetch(download_url, fpath)
+        store.alias(download_url, await asyncio.to_thread(store.add, fpath, sha256))
 
     return fname
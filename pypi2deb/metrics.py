@@ -0,0 +1,194 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Pipeline metrics in OpenMetrics text format.
+
+Metrics are collected in the current process (counters are cheap, so
+they're always on) and exposed either via a small HTTP server (for
+Prometheus) or a text file (for node exporter's textfile collector).
+"""
+
+import asyncio
+import logging
+import os
+import re
+from contextlib import contextmanager
+from time import monotonic
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'collector', 'timer', 'reason',
+           'serve', 'write', 'STAGE_DURATION', 'PACKAGES', 'FAILURES', 'DOWNLOADED']
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+log = logging.getLogger('pypi2deb')
+
+_metrics = []
+_collectors = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                           .replace('"', r'\"').replace('\n', r'\n'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount=1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value, *labels):
+        """Set value (f.e. of a counter maintained elsewhere)."""
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '{}_total{} {}'.format(self.name, _labels(self.labels, labels), value)
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield '{}{} {}'.format(self.name, _labels(self.labels, labels), value)
+
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, doc, labels)
+
+    def observe(self, value, *labels):
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+        data[1] += 1
+        data[2] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, (buckets, count, total) in sorted(self.values.items()):
+            for bound, value in zip(self.buckets, buckets):
+                yield '{}_bucket{} {}'.format(self.name, _labels(names, labels + (bound,)), value)
+            yield '{}_bucket{} {}'.format(self.name, _labels(names, labels + ('+Inf',)), count)
+            yield '{}_count{} {}'.format(self.name, _labels(self.labels, labels), count)
+            yield '{}_sum{} {}'.format(self.name, _labels(self.labels, labels), total)
+
+
+STAGE_DURATION = Histogram('pypi2deb_stage_duration_seconds', 'Time spent in conversion stage',
+                           ('stage',))
+PACKAGES = Counter('pypi2deb_packages', 'Packages that finished a stage', ('stage', 'status'))
+FAILURES = Counter('pypi2deb_failures', 'Failed stages by reason', ('stage', 'reason'))
+DOWNLOADED = Counter('pypi2deb_downloaded_bytes', 'Bytes downloaded')
+
+
+def collector(func):
+    """Register function called before metrics are rendered (f.e. to set gauges)."""
+    _collectors.append(func)
+    return func
+
+
+def render(openmetrics=True):
+    """Return all metrics in OpenMetrics (or Prometheus' text) format."""
+    for func in _collectors:
+        try:
+            func()
+        except Exception as err:
+            log.debug('metrics collector failed: %r', err)
+    lines = []
+    for metric in _metrics:
+        name = metric.name
+        if not openmetrics and metric.type == 'counter':
+            name += '_total'  # Prometheus' format names families after samples
+        lines.append('# TYPE {} {}'.format(name, metric.type))
+        lines.append('# HELP {} {}'.format(name, metric.doc))
+        lines.extend(metric.samples())
+    lines.append('# EOF\n' if openmetrics else '')
+    return '\n'.join(lines)
+
+
+@contextmanager
+def timer(stage):
+    """Measure duration of given stage."""
+    start = monotonic()
+    try:
+        yield
+    finally:
+        STAGE_DURATION.observe(monotonic() - start, stage)
+
+
+def reason(error):
+    """Return low cardinality failure reason for given error message."""
+    if not error:
+        return 'unknown'
+    # f.e. "ClientResponseError(...)", "return code 2", "dependency failed: foo"
+    return re.split(r'[:(]', str(error), 1)[0].strip()[:60] or 'unknown'
+
+
+async def _handle(reader, writer):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()).strip():
+            pass  # skip headers
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1] in (b'/', b'/metrics'):
+            body = render().encode('utf-8')
+            status = '200 OK'
+        else:
+            body, status = b'not found\n', '404 Not Found'
+        writer.write('HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(
+                         status, CONTENT_TYPE, len(body)).encode('ascii') + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(port, host='127.0.0.1'):
+    """Start HTTP server with /metrics endpoint, return asyncio server."""
+    server = await asyncio.start_server(_handle, host, port)
+    log.info('metrics available at http://%s:%d/metrics', host, port)
+    return server
+
+
+def write(fpath):
+    """Write metrics to given file (atomically), f.e. for node exporter."""
+    tmp = '{}.{}.tmp'.format(fpath, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as fp:
+        fp.write(render(openmetrics=False))
+    os.replace(tmp, fpath)
@@ -0,0 +1,216 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""On-disk index of egg names → Debian source names.
+
+dh-python's pydist data is parsed only when its files change; the result
+is saved as an open addressing hash table that every process memory-maps
+(pages are shared via page cache) instead of keeping its own dict.
+
+File layout (little endian):
+  header: magic, format version, number of slots, data files signature
+  slots:  (32-bit hash tag, 32-bit offset into strings) × number of slots
+  strings: (16-bit length, key, 16-bit length, value) entries
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from os import environ, listdir, makedirs
+from os.path import dirname, exists, expanduser, isdir, join
+from time import monotonic
+
+from dhpython import pydist
+
+__all__ = ['lookup', 'signature', 'INDEX_PATH']
+
+INDEX_PATH = environ.get('PYPI2DEB_NAME_INDEX',
+                         join(environ.get('XDG_CACHE_HOME', expanduser('~/.cache')),
+                              'pypi2deb', 'pydist-cpython3.idx'))
+# how often (in seconds) dh-python's data files are checked for changes
+CHECK_INTERVAL = 60
+IMPL = 'cpython3'
+MAGIC = b'P2DN'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sBxxxI16s')
+SLOT = struct.Struct('<II')
+LENGTH = struct.Struct('<H')
+log = logging.getLogger('pypi2deb')
+
+_index = None
+
+
+def _data_files():
+    """Return dh-python's files describing installed distributions."""
+    result = []
+    dname = getattr(pydist, 'PYDIST_DIRS', {}).get(IMPL, '/usr/share/python3/dist/')
+    if isdir(dname):
+        result.extend(join(dname, i) for i in listdir(dname))
+    fname = getattr(pydist, 'PYDIST_OVERRIDES_FNAMES', {}).get(IMPL)
+    if fname:
+        result.append(fname)
+    fbdir = environ.get('DH_PYTHON_DIST', join(dirname(pydist.__file__), 'dist'))
+    result.append(join(fbdir, '{}_fallback'.format(IMPL)))
+    return sorted(result)
+
+
+def _signature():
+    digest = hashlib.blake2b(digest_size=16)
+    for fpath in _data_files():
+        try:
+            stat = os.stat(fpath)
+        except OSError:
+            continue
+        digest.update('{}\0{}\0{}\n'.format(fpath, stat.st_mtime_ns, stat.st_size).encode())
+    return digest.digest()
+
+
+def _hash(key):
+    value = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+    # tag 0 marks an empty slot
+    return value, (value >> 32) or 1
+
+
+def _load_names():
+    result = {}
+    try:
+        data = pydist.load(IMPL)
+    except Exception as err:
+        log.warn('cannot load pydist names: %s', err)
+    else:
+        for key, details in data.items():
+            result[key.lower()] = details[0]['dependency'].replace('python3-', '')
+    return result
+
+
+def build(fpath, signature, names):
+    """Save pydist names in given file."""
+    size = max(len(names) * 2, 8)  # keep load factor <= 0.5
+    slots = bytearray(SLOT.size * size)
+    strings = bytearray()
+    offset = HEADER.size + len(slots)
+    for key, value in names.items():
+        key, value = key.encode('utf-8'), value.encode('utf-8')
+        hash_, tag = _hash(key)
+        pos = hash_ % size
+        while SLOT.unpack_from(slots, pos * SLOT.size)[0]:
+            pos = (pos + 1) % size
+        SLOT.pack_into(slots, pos * SLOT.size, tag, offset + len(strings))
+        strings += LENGTH.pack(len(key)) + key + LENGTH.pack(len(value)) + value
+
+    makedirs(dirname(fpath), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(fpath, os.getpid())
+    with open(tmp, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, FORMAT_VERSION, size, signature))
+        fp.write(slots)
+        fp.write(strings)
+    os.replace(tmp, fpath)
+    log.debug('pydist name index with %d names saved in %s', len(names), fpath)
+
+
+class _MemoryIndex(dict):
+    """Fallback used if the index cannot be saved."""
+
+    def __init__(self, names, signature):
+        super().__init__(names)
+        self.signature = signature
+        self.checked = monotonic()
+
+    def close(self):
+        pass
+
+
+class NameIndex:
+    def __init__(self, fpath):
+        with open(fpath, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size, self.signature = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != FORMAT_VERSION or not self.size:
+            self.data.close()
+            raise ValueError('unsupported name index format')
+        self.checked = monotonic()
+
+    def close(self):
+        self.data.close()
+
+    def get(self, name):
+        key = name.encode('utf-8')
+        hash_, tag = _hash(key)
+        pos = hash_ % self.size
+        data = self.data
+        for _ in range(self.size):
+            slot_tag, offset = SLOT.unpack_from(data, HEADER.size + pos * SLOT.size)
+            if not slot_tag:
+                return
+            if slot_tag == tag:
+                length = LENGTH.unpack_from(data, offset)[0]
+                offset += LENGTH.size
+                if data[offset:offset + length] == key:
+                    offset += length
+                    length = LENGTH.unpack_from(data, offset)[0]
+                    offset += LENGTH.size
+                    return data[offset:offset + length].decode('utf-8')
+            pos = (pos + 1) % self.size
+
+
+def _open():
+    global _index
+    now = monotonic()
+    if _index is not None and now - _index.checked < CHECK_INTERVAL:
+        return _index
+    signature = _signature()
+    if _index is not None and _index.signature == signature:
+        _index.checked = now
+        return _index
+
+    index = None
+    if exists(INDEX_PATH):
+        try:
+            index = NameIndex(INDEX_PATH)
+        except (OSError, ValueError) as err:
+            log.debug('cannot open pydist name index: %s', err)
+        else:
+            if index.signature != signature:
+                index.close()
+                index = None
+    if index is None:
+        names = _load_names()
+        try:
+            build(INDEX_PATH, signature, names)
+            index = NameIndex(INDEX_PATH)
+        except (OSError, ValueError) as err:
+            log.warn('cannot save pydist name index: %s', err)
+            index = _MemoryIndex(names, signature)
+    if _index is not None:
+        _index.close()
+    _index = index
+    return index
+
+
+def lookup(name):
+    """Return Debian source name for given (normalized, lower case) egg name or None."""
+    return _open().get(name)
+
+
+def signature():
+    """Return (hex) signature of dh-python's data the index was built from."""
+    return _open().signature.hex()
@@ -0,0 +1,327 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Shared HTTP client.
+
+One aiohttp session (and its connection pool) is used for all requests
+made during a single py2dsp / pypi2debian run, so that connections to
+PyPI, files.pythonhosted.org and GitHub are kept alive and reused.
+
+Requests to each host go through a token bucket (rate limit) and an
+AIMD concurrency limit: it grows while responses are fast and healthy
+and is halved on errors, 429s and 5xx responses, which are retried with
+jittered exponential backoff (honouring Retry-After).
+"""
+
+import asyncio
+import hashlib
+import logging
+import random
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from os import environ, rename, unlink
+from os.path import exists
+from time import monotonic, time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from pypi2deb.metrics import DOWNLOADED
+
+__all__ = ['session', 'close_session', 'request', 'throttle', 'fetch']
+
+HTTP_LIMIT = int(environ.get('PYPI2DEB_HTTP_LIMIT', 100))
+HTTP_LIMIT_PER_HOST = int(environ.get('PYPI2DEB_HTTP_LIMIT_PER_HOST', 10))
+HTTP_DNS_TTL = int(environ.get('PYPI2DEB_HTTP_DNS_TTL', 300))
+HTTP_KEEPALIVE = float(environ.get('PYPI2DEB_HTTP_KEEPALIVE', 30))
+HTTP_RETRIES = int(environ.get('PYPI2DEB_HTTP_RETRIES', 3))
+# requests per second (per host) and burst size
+HTTP_RATE = float(environ.get('PYPI2DEB_HTTP_RATE', 20))
+HTTP_BURST = int(environ.get('PYPI2DEB_HTTP_BURST', 40))
+# responses slower than this (in seconds) stop concurrency growth
+HTTP_LATENCY = float(environ.get('PYPI2DEB_HTTP_LATENCY', 2))
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+log = logging.getLogger('pypi2deb')
+
+_session = None
+_limiters = {}  # host → HostLimiter
+
+
+def session():
+    """Return HTTP session shared by all coroutines (create it if needed).
+
+    Has to be invoked with the event loop running.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=HTTP_LIMIT,
+                                         limit_per_host=HTTP_LIMIT_PER_HOST,
+                                         ttl_dns_cache=HTTP_DNS_TTL,
+                                         keepalive_timeout=HTTP_KEEPALIVE)
+        _session = aiohttp.ClientSession(connector=connector, trust_env=True)
+        log.debug('HTTP session created (limit: %d, per host: %d)',
+                  HTTP_LIMIT, HTTP_LIMIT_PER_HOST)
+    return _session
+
+
+async def close_session():
+    """Close shared HTTP session and release pooled connections."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class HostLimiter:
+    """Token bucket rate limit + AIMD concurrency limit for one host."""
+
+    def __init__(self, host, rate=HTTP_RATE, burst=HTTP_BURST, max_limit=HTTP_LIMIT_PER_HOST):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.max_limit = max_limit
+        self.limit = max(1.0, max_limit / 2)
+        self.active = 0
+        self.paused_until = 0
+        self.decreased = 0
+        self.cond = asyncio.Condition()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.cond:
+            while True:
+                now = monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.active >= int(self.limit):
+                    await self.cond.wait()
+                    continue
+                else:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.active += 1
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                try:
+                    await asyncio.wait_for(self.cond.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, latency, ok):
+        async with self.cond:
+            self.active -= 1
+            if ok:
+                if latency < HTTP_LATENCY and self.limit < self.max_limit:
+                    # additive increase: +1 per limit's worth of requests
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif monotonic() - self.decreased > latency:
+                # multiplicative decrease, once per round trip
+                self.limit = max(1.0, self.limit / 2)
+                self.decreased = monotonic()
+                log.debug('%s: concurrency limit decreased to %d', self.host, self.limit)
+            self.cond.notify_all()
+
+    def pause(self, delay):
+        """Do not send new requests to this host for delay seconds."""
+        self.paused_until = max(self.paused_until, monotonic() + delay)
+
+
+def _limiter(url):
+    host = urlsplit(url).netloc
+    limiter = _limiters.get(host)
+    if limiter is None:
+        limiter = _limiters[host] = HostLimiter(host)
+    return limiter
+
+
+def backoff(attempt):
+    """Return jittered exponential backoff delay for given attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(headers):
+    """Return delay (in seconds) requested via Retry-After header or 0."""
+    value = headers.get('Retry-After')
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return 0
+
+
+@asynccontextmanager
+async def throttle(url):
+    """Hold a slot of url's host limiter, f.e. for requests made by other libraries.
+
+    Yields a dict, set its 'ok' key to False if the request failed.
+    """
+    limiter = _limiter(url)
+    await limiter.acquire()
+    start = monotonic()
+    result = {'ok': True}
+    try:
+        yield result
+    except Exception:
+        result['ok'] = False
+        raise
+    finally:
+        await limiter.release(monotonic() - start, result['ok'])
+
+
+@asynccontextmanager
+async def request(url, method='GET', headers=None, retries=HTTP_RETRIES):
+    """Send rate limited HTTP request, retry connection errors, 429 and 5xx.
+
+    Yields aiohttp's response (the last one if all retries failed).
+    """
+    limiter = _limiter(url)
+    attempt = 0
+    while True:
+        await limiter.acquire()
+        start = monotonic()
+        try:
+            response = await session().request(method, url, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            await limiter.release(monotonic() - start, False)
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff(attempt)
+            log.debug('%s: request failed (%r), retrying in %.1fs', url, err, delay)
+            await asyncio.sleep(delay)
+            continue
+        latency = monotonic() - start
+        ok = response.status not in RETRY_STATUSES
+        if not ok and attempt < retries:
+            await limiter.release(latency, False)
+            response.release()
+            attempt += 1
+            delay = max(backoff(attempt), retry_after(response.headers))
+            if response.status == 429:
+                limiter.pause(delay)
+            log.debug('%s: HTTP %d, retrying in %.1fs', url, response.status, delay)
+            await asyncio.sleep(delay)
+            continue
+        try:
+            yield response
+        except Exception:
+            ok = False
+            raise
+        finally:
+            response.release()
+            await limiter.release(latency, ok)
+        return
+
+
+def _hash_file(fpath, digest):
+    size = 0
+    with open(fpath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+async def fetch(url, fpath, sha256=None, retries=HTTP_RETRIES):
+    """Download url to fpath in chunks and return its SHA256 hex digest.
+
+    Data is written to fpath.part and renamed to fpath once the download
+    is complete (and the digest matches, if given). If the transfer gets
+    interrupted, it's resumed with an HTTP Range request (retries are
+    handled here, not by request, so that they can resume).
+    """
+    part = fpath + '.part'
+    attempt = 0
+    while True:
+        digest = hashlib.sha256()
+        offset = _hash_file(part, digest) if exists(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            async with request(url, headers=headers, retries=0) as response:
+                if offset and response.status == 416 and not sha256:
+                    # nothing to verify .part file with, start over
+                    log.debug('%s: cannot resume download, restarting', url)
+                    unlink(part)
+                    attempt += 1
+                    if attempt > retries:
+                        raise Exception('cannot download {}: HTTP 416'.format(url))
+                    continue
+                if offset and response.status == 416:
+                    # .part file is complete (or bogus), let digest decide
+                    pass
+                else:
+                    response.raise_for_status()
+                    if offset and response.status != 206:
+                        log.debug('%s: range requests not supported, restarting', url)
+                        digest = hashlib.sha256()
+                        offset = 0
+                    with open(part, 'ab' if offset else 'wb') as fp:
+                        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                            fp.write(chunk)
+                            digest.update(chunk)
+                            DOWNLOADED.inc(len(chunk))
+        except aiohttp.ClientResponseError as err:
+            if err.status not in RETRY_STATUSES:
+                raise
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = max(backoff(attempt), retry_after(err.headers or {}))
+            if err.status == 429:
+                _limiter(url).pause(delay)
+            log.debug('%s: download failed (%r), retrying in %.1fs', url, err, delay)
+            await asyncio.sleep(delay)
+            continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            attempt += 1
+            if attempt > retries:
+                raise
+            delay = backoff(attempt)
+            log.debug('%s: download interrupted (%r), resuming in %.1fs', url, err, delay)
+            await asyncio.sleep(delay)
+            continue
+
+        hexdigest = digest.hexdigest()
+        if sha256 and hexdigest != sha256.lower():
+            unlink(part)
+            attempt += 1
+            if offset and attempt <= retries:
+                # resumed data could come from a different file, start over
+                log.debug('%s: checksum mismatch, downloading again', url)
+                continue
+            raise Exception('checksum mismatch for {}: expected {}, got {}'.format(
+                url, sha256, hexdigest))
+        rename(part, fpath)
+        return hexdigest
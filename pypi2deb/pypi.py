@@ -18,39 +18,158 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import asyncio
+import codecs
+import json
 import logging
-from os import environ
-from os.path import exists, join
-from xmlrpc.client import ServerProxy
-# from aioxmlrpc.client import ServerProxy  # TODO: package it in Debian
-import aiohttp
+import re
+from configparser import ConfigParser
+from email.parser import Parser
+from email.policy import compat32
+from os import environ, scandir
+from os.path import exists, isdir, isfile, join
+from time import time
+from urllib.parse import urlsplit
 
-from pypi2deb.decorators import cache
-from pypi2deb.tools import pkg_name, execute
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+from pypi2deb import store, trace
+from pypi2deb.cache import aload as _cache_aload, adump as _cache_adump
+from pypi2deb.net import fetch, request
+from pypi2deb.tools import pkg_name, execute, scan_archive
 
 PYPI_JSON_URL = environ.get('PYPI_JSON_URL', 'https://pypi.org/pypi')
-PYPI_XMLRPC_URL = environ.get('PYPI_XMLRPC_URL', 'https://pypi.org/pypi')
+PYPI_SIMPLE_URL = environ.get('PYPI_SIMPLE_URL', 'https://pypi.org/simple/')
+# JSON API responses younger than this (in seconds) are not revalidated
+PYPI_MAX_AGE = int(environ.get('PYPI2DEB_PYPI_MAX_AGE', 0))
+PYPI_CACHE_TTL = int(environ.get('PYPI2DEB_PYPI_CACHE_TTL', 7 * 24 * 3600))
+# bandersnatch style mirror (its web dir), used instead of PyPI if set
+MIRROR_PATH = environ.get('PYPI2DEB_MIRROR')
+SIMPLE_JSON_TYPE = 'application/vnd.pypi.simple.v1+json'
+SIMPLE_PROJECTS_RE = re.compile(r'"projects"\s*:\s*\[')
+SIMPLE_ANCHOR_RE = re.compile(r'<a\b[^>]*>\s*([^<]+?)\s*</a>', re.IGNORECASE)
 log = logging.getLogger('pypi2deb')
 
 
-async def get_pypi_info(name, version=None):
+def use_mirror(path):
+    """Read metadata and sdists from local mirror instead of PyPI.
+
+    :param path: bandersnatch style mirror (its root or web dir) or None
+        to use PyPI again
+    """
+    global MIRROR_PATH
+    if path and not isdir(join(path, 'json')) and isdir(join(path, 'web', 'json')):
+        path = join(path, 'web')
+    if path and not isdir(join(path, 'json')) and not isdir(join(path, 'pypi')):
+        raise Exception('{} is not a PyPI mirror (json dir is missing)'.format(path))
+    MIRROR_PATH = path
+
+
+def _canonical_name(name):
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _load_mirror_info(name, version=None):
+    for fpath in (join(MIRROR_PATH, 'json', name),
+                  join(MIRROR_PATH, 'json', _canonical_name(name)),
+                  join(MIRROR_PATH, 'pypi', name, 'json'),
+                  join(MIRROR_PATH, 'pypi', _canonical_name(name), 'json')):
+        if isfile(fpath):
+            break
+    else:
+        return
+    with open(fpath, encoding='utf-8') as fp:
+        data = json.load(fp)
+    if version and data['info']['version'] != version:
+        # mirrors keep the latest details only, other versions' files are
+        # listed in releases - read their metadata from the sdist
+        if version not in data.get('releases', {}):
+            return
+        data['urls'] = data['releases'][version]
+        info = None
+        for release in data['urls']:
+            if release.get('python_version') == 'source':
+                try:
+                    info = _sdist_info(_mirror_file(release['url']))
+                except Exception as err:
+                    log.debug('cannot read %s %s metadata: %r', name, version, err)
+                break
+        if info is None:
+            info = {'name': data['info']['name'], 'summary': 'FIXME', 'classifiers': []}
+            info.update(dict.fromkeys(('description', 'license', 'author', 'author_email',
+                                       'home_page'), ''))
+        info['version'] = version
+        data['info'] = info
+    return data
+
+
+def _mirror_file(url):
+    """Return path to mirrored file for given (PyPI's) URL."""
+    path = urlsplit(url).path
+    if '/packages/' not in path:
+        raise Exception('{} is not available on mirror'.format(url))
+    return join(MIRROR_PATH, 'packages', path.split('/packages/', 1)[1])
+
+
+async def get_pypi_info(name, version=None, max_age=None):
+    """Return project details from PyPI's JSON API (or local mirror).
+
+    Responses are cached together with their ETag / Last-Modified headers.
+    Cached copy younger than max_age seconds (PYPI2DEB_PYPI_MAX_AGE env.
+    variable by default) is used as is, older one gets revalidated with
+    a conditional request.
+    """
+    if MIRROR_PATH:
+        with trace.span('pypi_info', cat='mirror'):
+            result = await asyncio.to_thread(_load_mirror_info, name, version)
+        if result is None:
+            log.error('invalid project name: %s %s (not mirrored)', name, version or '')
+        return result
+
     url = PYPI_JSON_URL + '/' + name
     if version:
         url += '/' + version
     url += '/json'
 
-    async with aiohttp.ClientSession(trust_env=True) as session:
-        try:
-            response = await session.get(url)
-        except Exception as err:
-            log.error('invalid project name: {} ({})'.format(name, err))
-            return
-        try:
-            result = await response.json()
-        except Exception as err:
-            log.warn('cannot download %s %s details from PyPI: %r', name, version, err)
-            return
-        return result
+    max_age = PYPI_MAX_AGE if max_age is None else max_age
+    cache_key = 'pypi_json:' + url
+    cached = await _cache_aload(cache_key)
+    now = time()
+    if cached and now - cached['fetched'] < max_age:
+        return cached['data']
+
+    headers = {}
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        with trace.span('pypi_info', cat='network', url=url):
+            async with request(url, headers=headers) as response:
+                if cached and response.status == 304:
+                    cached['fetched'] = now
+                    await _cache_adump(cache_key, cached, PYPI_CACHE_TTL)
+                    return cached['data']
+                if response.status == 404:
+                    log.error('invalid project name: %s %s', name, version or '')
+                    return
+                response.raise_for_status()
+                result = await response.json()
+    except Exception as err:
+        if cached:
+            log.debug('%s: cannot revalidate cached details (%r)', name, err)
+            return cached['data']
+        # transient errors were already retried, let the caller decide
+        raise Exception('cannot download {} {} details from PyPI: {!r}'.format(
+            name, version or '', err)) from err
+    await _cache_adump(cache_key, {'etag': response.headers.get('ETag'),
+                                  'last_modified': response.headers.get('Last-Modified'),
+                                  'fetched': now,
+                                  'data': result}, PYPI_CACHE_TTL)
+    return result
 
 
 def parse_pypi_info(data):
@@ -102,13 +221,123 @@ def parse_pypi_info(data):
     return result
 
 
-def parse_pkg_info(fpath):
-    """Parse PKG-INFO file"""
-    raise NotImplementedError()  # FIXME
+def _info_from_pkg_info(text):
+    msg = Parser(policy=compat32).parsestr(text)
+    info = {
+        'name': msg.get('Name'),
+        'version': msg.get('Version'),
+        'summary': msg.get('Summary'),
+        'home_page': msg.get('Home-page'),
+        'author': msg.get('Author'),
+        'author_email': msg.get('Author-email'),
+        'license': msg.get('License'),
+        'classifiers': msg.get_all('Classifier') or [],
+        'requires_dist': msg.get_all('Requires-Dist') or [],
+    }
+    description = msg.get_payload() or msg.get('Description') or ''
+    info['description'] = description if isinstance(description, str) else ''
+    if not info['home_page']:
+        for url in msg.get_all('Project-URL') or []:
+            label, _, url = url.partition(',')
+            if label.strip().lower() in ('homepage', 'home', 'source'):
+                info['home_page'] = url.strip()
+                break
+    return info
+
 
+def _info_from_pyproject(text):
+    project = tomllib.loads(text).get('project', {})
+    authors = project.get('authors') or [{}]
+    license = project.get('license')
+    urls = {key.lower(): value for key, value in (project.get('urls') or {}).items()}
+    return {
+        'name': project.get('name'),
+        'version': project.get('version'),
+        'summary': project.get('description'),
+        'home_page': urls.get('homepage') or urls.get('source'),
+        'author': authors[0].get('name'),
+        'author_email': authors[0].get('email'),
+        'license': license.get('text') if isinstance(license, dict) else license,
+        'classifiers': project.get('classifiers') or [],
+        'requires_dist': project.get('dependencies') or [],
+    }
 
-async def download(name, version=None, destdir='.'):
-    details = await get_pypi_info(name, version)
+
+def _info_from_setup_cfg(text):
+    cfg = ConfigParser(interpolation=None)
+    cfg.read_string(text)
+    metadata = cfg['metadata'] if 'metadata' in cfg else {}
+    options = cfg['options'] if 'options' in cfg else {}
+
+    def lines(value):
+        return [i.strip() for i in (value or '').splitlines() if i.strip()]
+
+    return {
+        'name': metadata.get('name'),
+        'version': metadata.get('version'),
+        'summary': metadata.get('description'),
+        'home_page': metadata.get('url') or metadata.get('home_page'),
+        'author': metadata.get('author'),
+        'author_email': metadata.get('author_email'),
+        'license': metadata.get('license'),
+        'classifiers': lines(metadata.get('classifiers')),
+        'requires_dist': lines(options.get('install_requires')),
+    }
+
+
+def _sdist_info(fpath, scan=None):
+    """Return sdist's metadata as JSON API's "info" dict (or None)."""
+    if scan is None:
+        scan = scan_archive(fpath)
+    parsers = (('PKG-INFO', _info_from_pkg_info),
+               ('pyproject.toml', _info_from_pyproject),
+               ('setup.cfg', _info_from_setup_cfg))
+    info = {}
+    for fname, parser in parsers:
+        if fname not in scan:
+            continue
+        try:
+            details = parser(scan[fname])
+        except Exception as err:
+            log.debug('cannot parse %s from %s: %r', fname, fpath, err)
+            continue
+        for key, value in details.items():
+            if value and not info.get(key):
+                info[key] = value
+    if not info.get('name'):
+        return
+    for key in ('version', 'description', 'license', 'author', 'author_email', 'home_page'):
+        info[key] = info.get(key) or ''
+    info.setdefault('summary', 'FIXME')
+    info.setdefault('classifiers', [])
+    return info
+
+
+def parse_pkg_info(fpath, scan=None):
+    """Parse metadata of given sdist (tarball, zip file or directory).
+
+    PKG-INFO, pyproject.toml and setup.cfg (in this order) are read
+    straight from the archive, without unpacking it. Returns ctx in the
+    same format as parse_pypi_info does, with raw "classifiers" list added.
+
+    :param scan: result of tools.scan_archive(fpath) if already available
+    """
+    info = _sdist_info(fpath, scan)
+    if not info:
+        return {}
+    result = parse_pypi_info({'info': info})
+    result['classifiers'] = info['classifiers']
+    return result
+
+
+async def download(name, version=None, destdir='.', details=None):
+    """Download sdist of given project, return its file name (in destdir).
+
+    :param details: project details (as returned by get_pypi_info), if the
+        caller already has them
+    """
+    if details is None:
+        details = await get_pypi_info(name, version)
     if not details:
         raise Exception('cannot get PyPI project details for {}'.format(name))
 
@@ -149,12 +378,19 @@ async def download(name, version=None, destdir='.'):
     if exists(fpath):
         return fname
 
-    async with aiohttp.ClientSession() as session:
+    tpath = fpath if ext == orig_ext else join(destdir, release['filename'])
+    sha256 = release.get('digests', {}).get('sha256')
+    if MIRROR_PATH:
+        # zero-copy: hardlink (or reflink) mirrored file
+        mirrored = _mirror_file(release['url'])
+        log.debug('linking upstream tarball from %s', mirrored)
+        with trace.span('link_tarball', cat='mirror', path=mirrored):
+            await asyncio.to_thread(store.link, mirrored, tpath)
+    elif not store.place(sha256, tpath):
         log.debug(f"fetching upstream tarball from {release['url']}")
-        response = await session.get(release['url'])
-        with open(fpath if ext == orig_ext else join(destdir, release['filename']), 'wb') as fp:
-            data = await response.read()
-            fp.write(data)
+        with trace.span('fetch_tarball', cat='network', url=release['url']):
+            sha256 = await fetch(release['url'], tpath, sha256=sha256)
+        await asyncio.to_thread(store.add, tpath, sha256)
 
     if orig_ext != ext:
         cmd = ['mk-origtargz', '--rename', '--compression', 'xz',
@@ -167,17 +403,96 @@ async def download(name, version=None, destdir='.'):
     return fname
 
 
-@cache()
-def list_packages(classifiers=None):
-    client = ServerProxy(PYPI_XMLRPC_URL)
-    if not classifiers:
-        # packages = await client.list_packages()
-        packages = client.list_packages()
-        packages = dict.fromkeys(packages)
+class _SimpleIndexParser:
+    """Incremental parser of PEP 691 (JSON) and PEP 503 (HTML) project lists."""
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.format = None  # 'json' or 'html'
+        self.in_projects = False
+
+    def feed(self, data, final=False):
+        """Parse next chunk of data, return list of complete project names."""
+        self.buffer += self.decoder.decode(data, final)
+        if self.format is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return []
+            self.format = 'json' if stripped.startswith('{') else 'html'
+        if self.format == 'json':
+            return self._feed_json()
+        return self._feed_html()
+
+    def _feed_json(self):
+        result = []
+        if not self.in_projects:
+            match = SIMPLE_PROJECTS_RE.search(self.buffer)
+            if not match:
+                return result
+            self.in_projects = True
+            self.buffer = self.buffer[match.end():]
+        while True:
+            self.buffer = self.buffer.lstrip(' \t\r\n,')
+            if not self.buffer or self.buffer.startswith(']'):
+                break
+            try:
+                project, end = self.json_decoder.raw_decode(self.buffer)
+            except ValueError:
+                break  # incomplete entry, wait for more data
+            self.buffer = self.buffer[end:]
+            if isinstance(project, dict) and project.get('name'):
+                result.append(project['name'])
+        return result
+
+    def _feed_html(self):
+        result = []
+        end = 0
+        for match in SIMPLE_ANCHOR_RE.finditer(self.buffer):
+            result.append(match.group(1))
+            end = match.end()
+        self.buffer = self.buffer[end:]
+        return result
+
+
+async def iter_packages(index=None):
+    """Yield project names listed in PyPI's Simple API index.
+
+    Names are yielded as soon as they're parsed, without waiting for
+    the whole index to arrive.
+
+    :param index: index URL (PYPI_SIMPLE_URL env. variable or mirror's
+        index by default), path to a local copy of the index (JSON or HTML)
+        or a directory with one subdirectory per project
+    """
+    if not index and MIRROR_PATH:
+        index = join(MIRROR_PATH, 'simple')
+        # hashed layout (simple/a/aiohttp/) is listed in index files only
+        for fname in ('index.v1_json', 'index.html'):
+            if isfile(join(index, fname)):
+                index = join(index, fname)
+                break
+    index = index or PYPI_SIMPLE_URL
+    if isdir(index):
+        with scandir(index) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    yield entry.name
+        return
+
+    parser = _SimpleIndexParser()
+    if exists(index):
+        with open(index, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(64 * 1024), b''):
+                for name in parser.feed(chunk):
+                    yield name
     else:
-        # packages = await client.browse(classifiers)
-        packages = client.browse(classifiers)
-        # browse returns all versions, use the latest one only
-        # TODO: use LooseVersion
-        packages = dict(sorted(packages))
-    return packages
+        headers = {'Accept': '{}, text/html;q=0.1'.format(SIMPLE_JSON_TYPE)}
+        async with request(index, headers=headers) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                for name in parser.feed(chunk):
+                    yield name
+    for name in parser.feed(b'', final=True):
+        yield name
@@ -0,0 +1,144 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Dependency aware ordering of binary package builds.
+
+Packages converted in the same run can build depend on each other (via
+python3-<src_name> binary packages). A package is passed to the build
+queue only once all such dependencies are built (or will not be converted
+in this run); dependents of packages that failed are not built at all.
+As long as projects are still being listed, any dependency that is not
+settled yet can show up later and blocks the build.
+"""
+
+import logging
+import re
+
+__all__ = ['BuildScheduler']
+
+PREFIX = 'python3-'
+log = logging.getLogger('pypi2deb')
+
+
+def build_depends_sources(ctx):
+    """Return source names of python3-foo packages listed in ctx's build_depends."""
+    result = set()
+    for dependency in ctx.get('build_depends') or ():
+        for alternative in dependency.split('|'):
+            match = re.match(r'\s*([a-z0-9][a-z0-9.+-]+)', alternative)
+            if match and match.group(1).startswith(PREFIX):
+                result.add(match.group(1)[len(PREFIX):])
+    return result
+
+
+class BuildScheduler:
+    """Pass builds to the queue in topological order.
+
+    :param queue: build queue, (name, version, ctx) items are put into it
+    :param on_skip: called with (name, version, reason, ctx) for each build
+        skipped due to failed dependency
+    """
+
+    def __init__(self, queue, on_skip=None):
+        self.queue = queue
+        self.on_skip = on_skip
+        self.listing = True  # more projects can be listed
+        self.pending = set()  # src names that will (hopefully) be built
+        self.built = set()
+        self.failed = set()
+        self.skipped = set()  # src names that will not be built (filtered out)
+        self.waiting = {}  # src name → (name, version, ctx, dependencies)
+
+    def expect(self, src_name):
+        """Register package that's being converted in this run."""
+        if src_name not in self.built and src_name not in self.failed:
+            self.pending.add(src_name)
+
+    def add(self, name, version, ctx):
+        """Queue binary build once its dependencies are built."""
+        src_name = ctx['src_name']
+        self.pending.add(src_name)
+        dependencies = build_depends_sources(ctx) - {src_name}
+        failed = dependencies & self.failed
+        if failed:
+            self.fail(src_name, 'dependency failed: {}'.format(', '.join(sorted(failed))),
+                      (name, version, ctx))
+            return
+        if self.listing:
+            blockers = dependencies - self.built - self.skipped
+        else:
+            blockers = dependencies & self.pending
+        if blockers:
+            log.debug('%s %s: build waits for %s', name, version, ', '.join(sorted(blockers)))
+            self.waiting[src_name] = (name, version, ctx, blockers)
+        else:
+            self.queue.put_nowait((name, version, ctx))
+
+    def _release(self, src_name):
+        """Queue dependents that no longer wait for given package."""
+        for dependent, (name, version, ctx, blockers) in list(self.waiting.items()):
+            blockers.discard(src_name)
+            if not blockers:
+                del self.waiting[dependent]
+                self.queue.put_nowait((name, version, ctx))
+
+    def done(self, src_name):
+        """Mark package as built, queue dependents that are ready."""
+        self.pending.discard(src_name)
+        self.built.add(src_name)
+        self._release(src_name)
+
+    def skip(self, src_name):
+        """Mark package as not converted in this run (filtered out), queue dependents."""
+        self.pending.discard(src_name)
+        self.skipped.add(src_name)
+        self._release(src_name)
+
+    def fail(self, src_name, reason=None, package=None):
+        """Mark package as failed, skip everything that depends on it."""
+        self.pending.discard(src_name)
+        self.failed.add(src_name)
+        if package and self.on_skip:
+            name, version, ctx = package
+            self.on_skip(name, version, reason, ctx)
+        for dependent, (name, version, ctx, blockers) in list(self.waiting.items()):
+            if src_name in blockers and dependent in self.waiting:
+                del self.waiting[dependent]
+                log.info('%s %s: skipping build - %s failed', name, version, src_name)
+                self.fail(dependent, 'dependency failed: {}'.format(src_name),
+                          (name, version, ctx))
+
+    def listed(self):
+        """Stop waiting for dependencies that were not listed in this run."""
+        self.listing = False
+        for dependent, (name, version, ctx, blockers) in list(self.waiting.items()):
+            blockers &= self.pending
+            if not blockers:
+                del self.waiting[dependent]
+                self.queue.put_nowait((name, version, ctx))
+
+    def flush(self):
+        """Queue all waiting builds (dependency cycles, dependencies that never came)."""
+        for dependent, (name, version, ctx, blockers) in list(self.waiting.items()):
+            log.debug('%s %s: building without waiting for %s',
+                      name, version, ', '.join(sorted(blockers)))
+            self.queue.put_nowait((name, version, ctx))
+        self.waiting.clear()
+        self.pending.clear()
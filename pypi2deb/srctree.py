@@ -0,0 +1,142 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Index of unpacked upstream sources.
+
+The tree is scanned once and every debianize stage asks the index
+instead of hitting the file system with its own listdir/exists calls.
+"""
+
+import logging
+from collections import Counter
+from configparser import ConfigParser
+from functools import cached_property
+from os import scandir
+from os.path import join, splitext
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+__all__ = ['SourceTree']
+
+log = logging.getLogger('pypi2deb')
+
+
+class SourceTree:
+    """Files and directories found in unpacked sources.
+
+    All paths are relative to the top directory, '.' is the top directory
+    itself. debian/ is not indexed, it's generated by debianize stages.
+    """
+
+    def __init__(self, dpath):
+        self.dpath = dpath
+        self.files = {}  # directory → set of file names
+        self.dirs = {}  # directory → set of subdirectory names
+        self.extensions = Counter()
+        self._scan('.', dpath)
+
+    def _scan(self, rel, path):
+        files = self.files[rel] = set()
+        dirs = self.dirs[rel] = set()
+        try:
+            entries = list(scandir(path))
+        except OSError as err:
+            log.debug('cannot scan %s: %s', path, err)
+            return
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir:
+                if rel == '.' and entry.name == 'debian':
+                    continue
+                dirs.add(entry.name)
+            else:
+                files.add(entry.name)
+                ext = splitext(entry.name)[1]
+                if ext:
+                    self.extensions[ext.lower()] += 1
+        for name in dirs:
+            self._scan(name if rel == '.' else join(rel, name), join(path, name))
+
+    def listdir(self, rel='.'):
+        """Return names of files and directories in given directory."""
+        return self.files.get(rel, set()) | self.dirs.get(rel, set())
+
+    def isdir(self, rel):
+        return (rel.strip('/') or '.') in self.files
+
+    def exists(self, rel):
+        rel = rel.strip('/')
+        if rel in self.files:
+            return True
+        parent, _, name = rel.rpartition('/')
+        return name in self.files.get(parent or '.', ())
+
+    def walk(self):
+        """Yield (directory, file names) pairs, similar to os.walk."""
+        yield from self.files.items()
+
+    def read_text(self, rel):
+        """Return content of given file or None if it's missing or unreadable."""
+        if not self.exists(rel):
+            return
+        try:
+            with open(join(self.dpath, rel), encoding='utf-8', errors='replace') as fp:
+                return fp.read()
+        except OSError as err:
+            log.debug('cannot read %s: %s', rel, err)
+
+    @cached_property
+    def setup_py(self):
+        """setup.py lines (without comments) or None."""
+        content = self.read_text('setup.py')
+        if content is None:
+            return
+        return [line for line in content.splitlines() if not line.startswith('#')]
+
+    @cached_property
+    def pyproject(self):
+        """Parsed pyproject.toml or None."""
+        content = self.read_text('pyproject.toml')
+        if content is None:
+            return
+        try:
+            return tomllib.loads(content)
+        except tomllib.TOMLDecodeError as err:
+            log.warn('cannot parse pyproject.toml: %s', err)
+            return {}
+
+    @cached_property
+    def setup_cfg(self):
+        """Parsed setup.cfg (ConfigParser instance) or None."""
+        content = self.read_text('setup.cfg')
+        if content is None:
+            return
+        config = ConfigParser()
+        try:
+            config.read_string(content)
+        except Exception as err:
+            log.warn('cannot parse setup.cfg: %s', err)
+        return config
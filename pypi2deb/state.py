@@ -0,0 +1,147 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Conversion state database.
+
+Keeps track of every converted (name, version) pair: the last pipeline
+stage it reached, when, and with what outcome, so that an interrupted
+pypi2debian run can be resumed without starting from scratch.
+"""
+
+import json
+import logging
+import sqlite3
+from time import time
+
+from pypi2deb.metrics import FAILURES, PACKAGES, reason as failure_reason
+
+__all__ = ['STAGES', 'RUNNING', 'OK', 'FAILED', 'SKIPPED', 'StateDB']
+
+# pipeline stages, in order
+STAGES = ('fetched', 'unpacked', 'debianized', 'source-built', 'binary-built')
+RUNNING, OK, FAILED, SKIPPED = 'running', 'ok', 'failed', 'skipped'
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    stage TEXT,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    updated REAL NOT NULL,
+    error TEXT,
+    tarball TEXT,
+    ctx TEXT,
+    PRIMARY KEY (name, version));
+CREATE INDEX IF NOT EXISTS packages_name ON packages (name, updated);
+CREATE TABLE IF NOT EXISTS stages (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    error TEXT);
+'''
+log = logging.getLogger('pypi2deb')
+
+
+def _dump_ctx(ctx):
+    sets = [key for key, value in ctx.items() if isinstance(value, set)]
+    ctx = {key: (sorted(value) if key in sets else value) for key, value in ctx.items()}
+    return json.dumps({'ctx': ctx, 'sets': sets}, default=str)
+
+
+def _load_ctx(data):
+    data = json.loads(data)
+    ctx = data['ctx']
+    for key in data['sets']:
+        ctx[key] = set(ctx[key])
+    return ctx
+
+
+class StateDB:
+    def __init__(self, fpath):
+        self.conn = sqlite3.connect(fpath, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, name, version=None):
+        """Return the most recent record for given project (as a dict) or None.
+
+        ctx is deserialized, f.e. sets are recovered from JSON lists.
+        """
+        if version:
+            row = self.conn.execute('SELECT * FROM packages WHERE name = ? AND version = ?',
+                                    (name, version)).fetchone()
+        else:
+            row = self.conn.execute('SELECT * FROM packages WHERE name = ? '
+                                    'ORDER BY updated DESC LIMIT 1', (name,)).fetchone()
+        if row is None:
+            return
+        result = dict(row)
+        result['ctx'] = _load_ctx(row['ctx']) if row['ctx'] else None
+        return result
+
+    def _set(self, name, version, stage, status, error=None, tarball=None, ctx=None):
+        now = time()
+        self.conn.execute('''
+            INSERT INTO packages (name, version, stage, status, started, updated, error, tarball, ctx)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (name, version) DO UPDATE SET
+                stage = excluded.stage, status = excluded.status, updated = excluded.updated,
+                error = excluded.error, tarball = coalesce(excluded.tarball, tarball),
+                ctx = coalesce(excluded.ctx, ctx)''',
+                          (name, version or '', stage, status, now, now, error, tarball,
+                           _dump_ctx(ctx) if ctx is not None else None))
+        return now
+
+    def start(self, name, version, stage):
+        """Mark stage as started."""
+        now = self._set(name, version, stage, RUNNING)
+        self.conn.execute('INSERT INTO stages (name, version, stage, status, started) '
+                          'VALUES (?, ?, ?, ?, ?)', (name, version or '', stage, RUNNING, now))
+
+    def _finish(self, name, version, stage, status, error=None, tarball=None, ctx=None):
+        now = self._set(name, version, stage, status, error, tarball, ctx)
+        PACKAGES.inc(1, stage, status)
+        if status == FAILED:
+            FAILURES.inc(1, stage, failure_reason(error))
+        self.conn.execute('''
+            UPDATE stages SET status = ?, finished = ?, error = ?
+            WHERE rowid = (SELECT max(rowid) FROM stages
+                           WHERE name = ? AND version = ? AND stage = ?)''',
+                          (status, now, error, name, version or '', stage))
+
+    def done(self, name, version, stage, tarball=None, ctx=None):
+        """Mark stage as successfully finished, save ctx needed by next stages."""
+        self._finish(name, version, stage, OK, tarball=tarball, ctx=ctx)
+
+    def fail(self, name, version, stage, error):
+        """Mark stage as failed."""
+        self._finish(name, version, stage, FAILED, error=str(error))
+
+    def skip(self, name, version, reason):
+        """Mark project as not meant to be converted."""
+        self._set(name, version, None, SKIPPED, error=reason)
+        PACKAGES.inc(1, 'none', SKIPPED)
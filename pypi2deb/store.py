@@ -0,0 +1,229 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Content-addressed store of upstream tarballs.
+
+Tarballs are kept under their SHA256 digest and placed into result
+directories via hardlinks (or reflinks, if hardlinks are not possible)
+so that the same upstream release is downloaded and stored only once,
+no matter how many --root directories use it. Files are copied (or
+reflinked) into the store, never hardlinked, so that changing the
+original file doesn't change the stored one.
+"""
+
+import hashlib
+import logging
+import os
+from fcntl import ioctl
+from os import environ, makedirs, unlink, utime, walk
+from os.path import exists, expanduser, join, samefile
+from shutil import copyfile
+
+__all__ = ['file_digest', 'lookup', 'add', 'place', 'alias', 'resolve_alias', 'link',
+           'copy', 'is_same_file']
+
+STORE_PATH = environ.get('PYPI2DEB_STORE_PATH',
+                         join(environ.get('XDG_CACHE_HOME', expanduser('~/.cache')),
+                              'pypi2deb', 'sdists'))
+# size limit in MiB, 0 disables the store
+STORE_SIZE = int(environ.get('PYPI2DEB_STORE_SIZE', 4096)) * 1024 * 1024
+FICLONE = 0x40049409
+# stored files share mtime with their hardlinks, last use is kept aside
+USED_SUFFIX = '.used'
+log = logging.getLogger('pypi2deb')
+_size = None  # store size (in bytes) as seen by this process, None: not known yet
+
+
+def file_digest(fpath):
+    """Return SHA256 hex digest of given file."""
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _object_path(sha256):
+    sha256 = sha256.lower()
+    return join(STORE_PATH, 'objects', sha256[:2], sha256)
+
+
+def _alias_path(key):
+    return join(STORE_PATH, 'aliases', hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _copy(src, tmp):
+    try:
+        with open(src, 'rb') as src_fp, open(tmp, 'wb') as dst_fp:
+            ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+    except OSError:
+        copyfile(src, tmp)
+
+
+def link(src, dst):
+    """Make dst a hardlink / reflink / copy of src (in this order)."""
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        _copy(src, tmp)
+    os.replace(tmp, dst)
+
+
+def copy(src, dst):
+    """Make dst a reflink / copy of src (in this order)."""
+    tmp = '{}.{}.tmp'.format(dst, os.getpid())
+    try:
+        _copy(src, tmp)
+    except BaseException:
+        if exists(tmp):
+            unlink(tmp)
+        raise
+    os.replace(tmp, dst)
+
+
+def _mark_used(fpath):
+    try:
+        with open(fpath + USED_SUFFIX, 'a'):
+            pass
+        utime(fpath + USED_SUFFIX)
+    except OSError as err:
+        log.debug('cannot mark %s as used: %s', fpath, err)
+
+
+def lookup(sha256):
+    """Return path to stored file with given digest or None."""
+    if not STORE_SIZE or not sha256:
+        return
+    fpath = _object_path(sha256)
+    if exists(fpath):
+        _mark_used(fpath)
+        return fpath
+
+
+def place(sha256, dst):
+    """Place stored file with given digest in dst, return True on success."""
+    fpath = lookup(sha256)
+    if not fpath:
+        return False
+    try:
+        link(fpath, dst)
+    except OSError as err:
+        log.warn('cannot use %s from sdist store: %s', sha256, err)
+        return False
+    log.debug('%s taken from sdist store', dst)
+    return True
+
+
+def add(fpath, sha256=None):
+    """Add file to the store (if not already there) and return its digest.
+
+    The file is copied (or reflinked), can take a while - do not call it
+    from the event loop.
+    """
+    global _size
+    sha256 = sha256 or file_digest(fpath)
+    if not STORE_SIZE:
+        return sha256
+    obj_fpath = _object_path(sha256)
+    if exists(obj_fpath):
+        return sha256
+    try:
+        makedirs(join(STORE_PATH, 'objects', sha256[:2]), exist_ok=True)
+        copy(fpath, obj_fpath)
+        _mark_used(obj_fpath)
+    except OSError as err:
+        log.warn('cannot add %s to sdist store: %s', fpath, err)
+        return sha256
+    if _size is None:
+        evict()  # the store is walked once, the size is tracked then
+    else:
+        _size += os.stat(obj_fpath).st_size
+        if _size > STORE_SIZE:
+            evict()
+    return sha256
+
+
+def alias(key, sha256):
+    """Remember digest of file identified by key (f.e. an URL)."""
+    if not STORE_SIZE:
+        return
+    fpath = _alias_path(key)
+    try:
+        makedirs(join(STORE_PATH, 'aliases'), exist_ok=True)
+        with open(fpath + '.tmp', 'w') as fp:
+            fp.write(sha256)
+        os.replace(fpath + '.tmp', fpath)
+    except OSError as err:
+        log.debug('cannot save sdist store alias for %s: %s', key, err)
+
+
+def resolve_alias(key):
+    """Return digest remembered for given key or None."""
+    fpath = _alias_path(key)
+    if STORE_SIZE and exists(fpath):
+        with open(fpath) as fp:
+            return fp.read().strip() or None
+
+
+def _last_used(fpath):
+    for path in (fpath + USED_SUFFIX, fpath):
+        try:
+            return os.stat(path).st_mtime
+        except FileNotFoundError:
+            continue
+    return 0
+
+
+def evict(limit=None):
+    """Remove least recently used files until store fits in the size limit."""
+    global _size
+    limit = STORE_SIZE if limit is None else limit
+    objects = []
+    total = 0
+    for root, dirs, file_names in walk(join(STORE_PATH, 'objects')):
+        for fn in file_names:
+            if fn.endswith(USED_SUFFIX) or fn.endswith('.tmp'):
+                continue
+            fpath = join(root, fn)
+            try:
+                size = os.stat(fpath).st_size
+            except FileNotFoundError:
+                continue
+            objects.append((_last_used(fpath), size, fpath))
+            total += size
+    if total > limit:
+        objects.sort()
+        for mtime, size, fpath in objects:
+            if total <= limit:
+                break
+            for path in (fpath, fpath + USED_SUFFIX):
+                try:
+                    unlink(path)
+                except FileNotFoundError:
+                    pass
+            log.debug('%s evicted from sdist store', fpath)
+            total -= size
+    _size = total
+
+
+def is_same_file(src, dst):
+    """Check if dst exists and points to the same file as src."""
+    return exists(dst) and samefile(src, dst)
@@ -20,15 +20,26 @@
 
 import asyncio
 import logging
+import multiprocessing
 import os
 import re
 import tarfile
+import zipfile
 from datetime import datetime
-from os.path import exists, join
+from fnmatch import fnmatch
+from os import environ
+from concurrent.futures import ProcessPoolExecutor
+from os.path import basename, exists, isdir, join
 from shlex import split
 from shutil import rmtree
-from pypi2deb.decorators import cache
-from dhpython.pydist import load, safe_name
+from tempfile import mkdtemp
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+from pypi2deb import trace
+from pypi2deb.nameindex import lookup
+from dhpython.pydist import safe_name
 
 
 FILENAME_RE = re.compile(r'''
@@ -42,10 +53,74 @@ FILENAME_RE = re.compile(r'''
         (?P<extension>(?:tar(?:\.[a-z0-9]+)?)|(?:zip))
     )?$
 ''', re.VERBOSE)
+METADATA_FILES = ('PKG-INFO', 'pyproject.toml', 'setup.cfg')
+# colon separated list of glob patterns of files that shouldn't be extracted
+UNPACK_EXCLUDE = [i for i in environ.get('PYPI2DEB_UNPACK_EXCLUDE', '').split(':') if i]
+# refuse to extract absolute paths, links outside the tree, device files, etc.
+TAR_FILTER = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
 log = logging.getLogger('pypi2deb')
 
 
-def unpack(fpath, destdir='.', dname=None):
+def _open_tar_stream(fpath):
+    """Open tarball for sequential (single pass) reading."""
+    if fpath.endswith(('.zst', '.zstd')):
+        if zstandard is None:
+            raise Exception('cannot read {}: zstandard module (python3-zstandard)'
+                            ' is not available'.format(fpath))
+        fp = open(fpath, 'rb')
+        reader = zstandard.ZstdDecompressor().stream_reader(fp)
+        tar = tarfile.open(fileobj=reader, mode='r|')
+        tar._pypi2deb_files = (reader, fp)  # close them with the tarball
+        return tar
+    return tarfile.open(fpath, 'r|*')
+
+
+def _close_tar_stream(tar):
+    tar.close()
+    for fp in getattr(tar, '_pypi2deb_files', ()):
+        fp.close()
+
+
+def iter_archive(fpath):
+    """Iterate over members of tarball or zip file in a single pass.
+
+    Yields (name, member, archive) tuples, where member is a TarInfo or
+    ZipInfo object, and archive - opened TarFile or ZipFile object that
+    can be used to read (or extract) current member.
+    """
+    if fpath.endswith('.zip'):
+        with zipfile.ZipFile(fpath) as archive:
+            for member in archive.infolist():
+                yield member.filename, member, archive
+    else:
+        archive = _open_tar_stream(fpath)
+        try:
+            for member in archive:
+                yield member.name, member, archive
+        finally:
+            _close_tar_stream(archive)
+
+
+def _member_is_dir(memb):
+    return memb.is_dir() if isinstance(memb, zipfile.ZipInfo) else memb.isdir()
+
+
+def _is_excluded(path, exclude):
+    parts = path.split('/')
+    if parts[0] == 'debian' or '.git' in parts:
+        return True
+    return any(fnmatch(path, pattern) for pattern in exclude)
+
+
+def unpack(fpath, destdir='.', dname=None, exclude=None):
+    """Extract tarball / zip file in destdir, in a single pass.
+
+    Top level directory is renamed to dname (if set); files that do not
+    belong to a top level directory are extracted to dname (or
+    "extracted") directory. Upstream debian dir, .git dirs and paths
+    matching exclude (or PYPI2DEB_UNPACK_EXCLUDE) glob patterns are not
+    extracted at all.
+    """
     if dname:
         dst_dpath = join(destdir, dname)
         if exists(dst_dpath):
@@ -53,35 +128,106 @@ def unpack(fpath, destdir='.', dname=None):
             return dst_dpath
     else:
         dst_dpath = None
+    exclude = UNPACK_EXCLUDE if exclude is None else exclude
+
+    tmp_dpath = mkdtemp(prefix='.unpack-', dir=destdir)
+    os.chmod(tmp_dpath, 0o755)
+    prefix = None
+    try:
+        for name, memb, archive in iter_archive(fpath):
+            name = name.rstrip('/')
+            if not name or name.startswith('/') or '..' in name.split('/'):
+                log.warn('skipping invalid file name: %s', name)
+                continue
+            isdir_ = _member_is_dir(memb)
 
-    fname = fpath.rsplit('/', 1)[-1]
-    if '.tar.' in fname:
-        with tarfile.open(fpath, 'r') as tar:
-            members = []
-            for memb in tar.getmembers():
-                if memb.name.startswith('/') or '../' in memb.name:
-                    log.warn('skipping invalid file name: %s', memb.name)
+            if prefix is None:  # first member
+                if '/' not in name and not isdir_:
+                    prefix = ''
+                    dst_dpath = join(destdir, dname or 'extracted')
+                else:
+                    prefix = name.split('/', 1)[0]
+                    dst_dpath = dst_dpath or join(destdir, prefix)
+                if exists(dst_dpath):
+                    log.debug('{} already exists, no need to unpack'.format(dst_dpath))
+                    return dst_dpath
+
+            if prefix:
+                if name == prefix:
                     continue
-                members.append(memb)
+                if name.startswith(prefix + '/'):
+                    name = name[len(prefix) + 1:]
+                else:
+                    log.warn('%s is outside %s directory', name, prefix)
+            if _is_excluded(name, exclude):
+                continue
+
+            if isinstance(memb, zipfile.ZipInfo):
+                memb.filename = name + ('/' if isdir_ else '')
+                path = archive.extract(memb, tmp_dpath)
+                mode = memb.external_attr >> 16
+                if mode & 0o111 and not isdir_:
+                    os.chmod(path, 0o755)
+            else:
+                memb.name = name
+                if memb.islnk() and prefix and memb.linkname.startswith(prefix + '/'):
+                    memb.linkname = memb.linkname[len(prefix) + 1:]
+                try:
+                    archive.extract(memb, tmp_dpath, **TAR_FILTER)
+                except tarfile.TarError as err:
+                    log.warn('skipping %s: %s', name, err)
 
-            dirname = members[0].name
-            if not members[0].isdir():
-                destdir = dst_dpath = join(destdir, dname or 'extracted')
-                dirname = dname = None
-                if exists(destdir):
-                    log.debug('{} already exists, no need to unpack'.format(destdir))
-                    return destdir
-            elif not dst_dpath:
-                dst_dpath = join(destdir, dirname)
+        if prefix is None:
+            raise Exception('empty archive: {}'.format(fpath))
+        os.rename(tmp_dpath, dst_dpath)
+    finally:
+        if exists(tmp_dpath):
+            rmtree(tmp_dpath)
+    return dst_dpath
 
-            tar.extractall(destdir, members)
-        if dname and dname != dirname:
-            os.rename(join(destdir, dirname), dst_dpath)
 
-        upstream_debian = os.path.join(dst_dpath, 'debian')
-        if os.path.exists(upstream_debian):
-            rmtree(upstream_debian)
-        return dst_dpath
+def scan_archive(fpath, stop_after=None):
+    """Read metadata files from tarball, zip file or source directory.
+
+    Nothing is extracted to disk. Returns dict with PKG-INFO,
+    pyproject.toml and setup.cfg contents (if available) and set of top
+    level file names in "files".
+
+    :param stop_after: stop reading the archive once this metadata file is
+        read (other files and "files" are incomplete then)
+    """
+    result = {'files': set()}
+    if isdir(fpath):
+        result['files'].update(os.listdir(fpath))
+        for name in METADATA_FILES:
+            if name in result['files']:
+                with open(join(fpath, name), encoding='utf-8', errors='replace') as fp:
+                    result[name] = fp.read()
+        return result
+
+    prefix = None
+    for name, memb, archive in iter_archive(fpath):
+        name = name.rstrip('/')
+        if prefix is None:
+            prefix = name.split('/', 1)[0] if '/' in name or _member_is_dir(memb) else ''
+        if prefix and name.startswith(prefix + '/'):
+            name = name[len(prefix) + 1:]
+        elif prefix:
+            continue
+        if '/' not in name:
+            result['files'].add(name)
+        if name not in METADATA_FILES or name in result:
+            continue
+        if isinstance(memb, zipfile.ZipInfo):
+            data = archive.read(memb)
+        elif memb.isfile():
+            data = archive.extractfile(memb).read()
+        else:
+            continue
+        result[name] = data.decode('utf-8', errors='replace')
+        if name == stop_after:
+            break
+    return result
 
 
 def parse_filename(name):
@@ -112,36 +258,41 @@ async def execute(command, cwd=None, env=None, log_output=None):
         command = split(command)
     log.debug('invoking: %s in %s', command, cwd)
 
-    create = asyncio.create_subprocess_exec(*command, stdout=log_output, stderr=log_output,
-                                            cwd=cwd, env=env)
-    proc = await create
-    await proc.wait()
+    with trace.span(basename(command[0]), cat='subprocess', command=' '.join(command)):
+        create = asyncio.create_subprocess_exec(*command, stdout=log_output, stderr=log_output,
+                                                cwd=cwd, env=env)
+        proc = await create
+        await proc.wait()
     close and log_output.close()
 
     return proc.returncode
 
 
+def _init_worker(log_level, log_format):
+    if not logging.getLogger().handlers:
+        logging.basicConfig(format=log_format)
+    log.setLevel(log_level)
+
+
+def process_pool(workers, log_format=None):
+    """Return process pool for CPU bound tasks (unpacking, debianizing).
+
+    Workers are started via forkserver, they do not inherit parent's event
+    loop, open sockets or database connections.
+    """
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver'),
+                               initializer=_init_worker,
+                               initargs=(log.getEffectiveLevel(), log_format))
+
+
 def pkg_name(name):
-    names = _load_package_names()
     name = safe_name(name).lower()
-    if name in names:
-        return names[name]
+    result = lookup(name)
+    if result:
+        return result
     result = name.lower().replace('-python', '').replace('python-', '')
     if result.endswith('.py'):
         result = result[:-3]
     result = re.sub('[^a-z0-9.-]', '-', result)
     return result
 
-
-@cache()
-def _load_package_names():
-    result = {}
-    try:
-        data = load('cpython3')
-    except Exception as err:
-        log.warn('cannot load pydist names: %s', err)
-        data = {}
-    else:
-        for key, details in data.items():
-            result[key.lower()] = details[0]['dependency'].replace('python3-', '')
-    return result
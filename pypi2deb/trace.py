@@ -0,0 +1,135 @@
+# Copyright © 2015-2018 Piotr Ożarowski <piotr@debian.org>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Conversion timeline in Chrome's trace event format.
+
+Spans are recorded only if tracing is enabled (--trace FILE). Each span
+is tagged with the worker that runs it (shown as a thread) and the
+package it works on. The resulting file can be loaded in Perfetto
+(ui.perfetto.dev) or chrome://tracing.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic_ns
+
+__all__ = ['enable', 'enabled', 'span', 'set_worker', 'set_package', 'context', 'collect',
+           'extend', 'write']
+
+_events = None  # None: tracing is disabled
+_threads = {}  # worker name → tid
+_worker = ContextVar('pypi2deb_trace_worker', default='main')
+_package = ContextVar('pypi2deb_trace_package', default=None)
+
+
+def enable():
+    global _events
+    if _events is None:
+        _events = []
+
+
+def enabled():
+    return _events is not None
+
+
+def set_worker(name):
+    """Name the worker (timeline row) running current task."""
+    _worker.set(name)
+
+
+def set_package(name):
+    """Set package current task works on."""
+    _package.set(name)
+
+
+def context():
+    """Return current worker and package, f.e. to pass them to another process."""
+    return {'worker': _worker.get(), 'package': _package.get()}
+
+
+def _tid(worker):
+    tid = _threads.get(worker)
+    if tid is None:
+        tid = _threads[worker] = len(_threads) + 1
+        _events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                        'args': {'name': worker}})
+    return tid
+
+
+@contextmanager
+def span(name, cat='stage', **args):
+    """Record duration of the block as a complete ("X") event."""
+    if _events is None:
+        yield
+        return
+    package = _package.get()
+    if package:
+        args['package'] = package
+    tid = _tid(_worker.get())
+    start = monotonic_ns()
+    try:
+        yield
+    except BaseException as err:
+        args['error'] = repr(err)
+        raise
+    finally:
+        _events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                        'ts': start / 1000, 'dur': (monotonic_ns() - start) / 1000,
+                        'args': args})
+
+
+def collect():
+    """Return and forget events recorded so far (in a worker process)."""
+    global _events
+    if _events is None:
+        return []
+    events, _events = _events, []
+    _threads.clear()  # re-emit thread names with the next batch
+    return events
+
+
+def extend(events):
+    """Add events recorded in another process.
+
+    Events are moved to the worker's row in this process (pool processes
+    run tasks of many workers).
+    """
+    if _events is None:
+        return
+    names = {}  # (pid, tid) → worker name
+    for event in events:
+        if event['ph'] == 'M' and event['name'] == 'thread_name':
+            names[event['pid'], event['tid']] = event['args']['name']
+    pid = os.getpid()
+    for event in events:
+        if event['ph'] == 'M':
+            continue
+        worker = names.get((event['pid'], event['tid']))
+        event['pid'] = pid
+        event['tid'] = _tid(worker) if worker else event['tid']
+        _events.append(event)
+
+
+def write(fpath):
+    """Save all recorded events in given file."""
+    with open(fpath, 'w', encoding='utf-8') as fp:
+        json.dump({'traceEvents': _events or [], 'displayTimeUnit': 'ms'}, fp)
@@ -0,0 +1,50 @@
+import io
+import tarfile
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+
+from pypi2deb.pypi import parse_pkg_info
+from pypi2deb.tools import scan_archive
+
+PKG_INFO = '''Metadata-Version: 2.1
+Name: foo
+Version: 1.0
+Summary: foo library
+Classifier: Programming Language :: Python :: 3
+Classifier: Operating System :: POSIX :: Linux
+'''
+
+
+class TestParsePkgInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = TemporaryDirectory()
+        self.fpath = join(self.tmp_dir.name, 'foo-1.0.tar.gz')
+        with tarfile.open(self.fpath, 'w:gz') as tar:
+            for name, text in (('foo-1.0/setup.py', 'from setuptools import setup\n'),
+                               ('foo-1.0/PKG-INFO', PKG_INFO),
+                               ('foo-1.0/foo.py', '')):
+                data = text.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_classifiers(self):
+        ctx = parse_pkg_info(self.fpath)
+        self.assertEqual(ctx['name'], 'foo')
+        self.assertEqual(ctx['classifiers'], ['Programming Language :: Python :: 3',
+                                              'Operating System :: POSIX :: Linux'])
+
+    def test_classifiers_quick_scan(self):
+        scan = scan_archive(self.fpath, 'PKG-INFO')
+        self.assertNotIn('foo.py', scan['files'])
+        ctx = parse_pkg_info(self.fpath, scan)
+        self.assertIn('Operating System :: POSIX :: Linux', ctx['classifiers'])
+
+
+if __name__ == '__main__':
+    unittest.main()